@@ -1,8 +1,18 @@
 """Managing data structures and algorithms used by an IMRL agent."""
 
+# System
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
 # Third party
 import numpy as np
 import random
+import scipy.sparse
 
 # First party
 from imrl.agent.option.option import Option
@@ -11,13 +21,21 @@ from imrl.agent.policy.policy_fixed import FixedPolicy
 from imrl.agent.value_iteration import ValueIteration
 from imrl.agent.agent_viz import AgentViz
 from imrl.agent.agent_viz_disc import AgentVizDisc
-from imrl.agent.option.option import Subgoal
+from imrl.agent.option.model import DenseModel, ModelStack
+from imrl.agent.replay import ReplayBuffer
+from imrl.agent.sample_features import SampleFeatures
+from imrl.agent.sample_store import SampleStore
+from imrl.agent.subgoal_registry import SubgoalRegistry
+from imrl.agent import checkpoint
+from imrl.utils.linear_algebra import dense, inner, add_scaled, sparse_entries
 
 
 class Agent:
 
     def __init__(self, policy, fa, num_actions, alpha, gamma, eta, zeta, epsilon, plan_iter, sim_samples, sim_steps,
-                 retain_theta=True, subgoals=[], samples=[]):
+                 retain_theta=True, subgoals=[], samples=[], option_storage='dense', option_rank=20, option_dir=None,
+                 replay_capacity=0, replay_batch=256, vi_ordering='gauss_seidel', vi_tolerance=None, vi_residual_norm='max',
+                 vi_budget=None, plan_workers=0, plan_threshold=None, sim_batched=False):
         self.policy = policy
         self.fa = fa
         self.num_actions = num_actions
@@ -29,27 +47,87 @@ class Agent:
         self.plan_iterations = plan_iter
         self.sim_samples = sim_samples
         self.sim_steps = sim_steps
-        self.subgoals = subgoals
-        self.samples = samples
-        self.reached_subgoals = []
+        # Simulate each option from all of its start samples together (see simulate_policy_batch)
+        self.sim_batched = sim_batched
+        self.subgoals = SubgoalRegistry(subgoals)
+        # The feature vectors of the samples are rows of sample_features, in the order they were added. sample_rows holds
+        # the row of each sample, in the order of samples.
+        self.samples = SampleStore(epsilon)
+        self.sample_features = SampleFeatures(fa.num_features, fa.dtype)
+        for s in samples:
+            self.evaluate_sample(s)
+        self.vi_ordering = vi_ordering
+        self.vi_tolerance = vi_tolerance
+        self.vi_residual_norm = vi_residual_norm
+        self.vi_budget = vi_budget
+        # Unless plan_workers is 0, subgoal options are planned and simulated concurrently in that many processes
+        self.plan_workers = plan_workers
+        # Unless plan_threshold is None, subgoal options whose planning_change is below it are not replanned
+        self.plan_threshold = plan_threshold
+        self.replanned = []
+        # Rows of the samples of the states visited since the last plan, which seed prioritized sweeping
+        self.touched_rows = set()
         self.extrinsic = None
-        self.intrinsic = [np.ones((self.fa.num_features, 1))] * num_actions
-        self.options = {i: Option(i, fa, FixedPolicy(num_actions, i), eta, gamma, None, num_actions) for i in range(num_actions)}
-        self.vi = ValueIteration(-1, self.intrinsic, self, plan_iter, retain_theta=retain_theta, use_options=False, alpha=alpha, gamma=gamma)
+        # Versions of the reward functions modified in place, by identity, to invalidate the options' reward projections
+        self.reward_versions = {}
+        self.option_storage = option_storage
+        self.option_rank = option_rank
+        # memmap option models are files in option_dir, by default a new temporary directory that is removed with the
+        # agent. Each agent needs its own.
+        self.option_dir = option_dir
+        if option_storage == 'memmap':
+            if option_dir is None:
+                self.option_dir = tempfile.mkdtemp(prefix='imrl-options-')
+                weakref.finalize(self, shutil.rmtree, self.option_dir, ignore_errors=True)
+            os.makedirs(self.option_dir, exist_ok=True)
+        # Every array of the agent takes the floating point dtype of its function approximator
+        self.intrinsic = [np.ones((self.fa.num_features, 1), dtype=fa.dtype) for _ in range(num_actions)]
+        self.options = {i: Option(i, fa, FixedPolicy(num_actions, i), eta, gamma, None, num_actions, storage=option_storage,
+                                  rank=option_rank, directory=self.option_dir) for i in range(num_actions)}
+        # Dense option models live in one contiguous stack, indexed by option id, for batched evaluation over options
+        self.model_stack = ModelStack(fa.num_features, num_actions + len(subgoals), fa.dtype) if option_storage == 'dense' else None
+        for i in range(num_actions):
+            self.stack_option(self.options[i])
+        # Unless replay_capacity is 0, the last replay_capacity transitions are kept and a mini-batch of them is replayed
+        # into the primitive option models at every plan
+        self.replay = ReplayBuffer(replay_capacity, fa.num_features, fa.dtype) if replay_capacity > 0 else None
+        self.replay_batch = replay_batch
+        self.vi = ValueIteration(-1, self.intrinsic, self, plan_iter, retain_theta=retain_theta, use_options=False, alpha=alpha, gamma=gamma,
+                                 ordering=vi_ordering, tolerance=vi_tolerance, residual_norm=vi_residual_norm,
+                                 budget=vi_budget)
         self.vi_policy = VIPolicy(num_actions, self.vi)
         self.option_stack = []
         self.step = 0
         self.viz = None
+        # The last state evaluated and its feature vector, which is reused until the agent moves on from the state
+        self.last = (None, None)
+        # Replaced by seeded generators in use_generators
+        self.random = random
+        self.np_random = np.random
 
     def create_visualization(self, discrete=False, gridworld=None):
         num_options = min(4, len(self.subgoals))
         self.viz = AgentVizDisc(self, num_options, gridworld) if discrete else AgentViz(self, num_options)
 
+    def use_generators(self, random_generator, numpy_generator):
+        """Draw every random choice of the agent, its policies, value iterations and replay buffer from the given
+        random.Random and numpy.random.RandomState instead of the random and numpy.random modules."""
+        self.random = random_generator
+        self.np_random = numpy_generator
+        self.policy.np_random = numpy_generator
+        for vi in [self.vi] + [self.options[i].policy.vi for i in range(self.num_actions, len(self.options))]:
+            vi.random = random_generator
+        if self.replay is not None:
+            self.replay.np_random = numpy_generator
+
     def choose_action(self, state):
         """Select an action from the base policy and add to option stack if necessary."""
-        fv = self.fa.evaluate(state)
+        return self.choose_action_from_fv(self.evaluate_state(state))
+
+    def choose_action_from_fv(self, fv):
+        """Select an action at the state with feature vector fv, as choose_action does."""
         if not self.option_stack:  # No executing options
-            o = self.policy.choose_action(state)
+            o = self.policy.choose_action_from_fv(fv)
             self.option_stack.append((o, fv, self.step))
         else:
             o, _, _ = self.option_stack[-1]
@@ -59,10 +137,25 @@ class Agent:
         # print([x[0] for x in self.option_stack])
         return o
 
+    def evaluate_state(self, state):
+        """Return the feature vector of the state, without evaluating the last state evaluated again."""
+        if state is not self.last[0]:
+            self.last = (state, self.fa.evaluate(state))
+        return self.last[1]
+
     def update(self, state, action, state_prime):
         """Update an agent's models based on a state, action, state tuple."""
-        fv = self.fa.evaluate(state)
+        fv = self.evaluate_state(state)
         fv_prime = self.fa.evaluate(state_prime)
+        self.update_options(action, state_prime, fv, fv_prime)
+        self.observe(state, action, fv, fv_prime)
+        self.update_intrinsic_reward(state, action)
+        self.last = (state_prime, fv_prime)
+        self.step += 1
+
+    def update_options(self, action, state_prime, fv, fv_prime):
+        """Update the models of the executing options with the transition from fv to fv_prime by the given action, and
+        pop the options that terminate in state_prime off the option stack."""
         assert self.option_stack != []
         o_idx, fv_old, start = self.option_stack[-1]
         assert o_idx == action
@@ -80,78 +173,204 @@ class Agent:
             o = self.options[o_idx]
         for o, _, _ in self.option_stack:
             self.options[o].update_u(fv, fv_prime, False)
-        self.evaluate_sample(state)
+
+    def observe(self, state, action, fv, fv_prime):
+        """Record a transition for replay, add its state to the samples if it is new and create the option of the
+        subgoal it reaches, if any."""
+        if self.replay is not None:
+            self.replay.add(action, fv, fv_prime, True)
+        self.touched_rows.add(self.evaluate_sample(state))
         self.evaluate_subgoal(state)
-        self.update_intrinsic_reward(state, action)
-        self.step += 1
 
     def update_intrinsic_reward(self, state, action):
-        fv = self.fa.evaluate(state)
-        self.intrinsic[action] = self.intrinsic[action] - self.zeta * np.dot(self.intrinsic[action].T, fv) * fv
-        assert np.max(self.vi.r[action]) <= 1.0
+        fv = self.evaluate_state(state)
+        r = self.intrinsic[action]
+        add_scaled(r, fv, -self.zeta * inner(r, fv).item())
+        self.reward_versions[id(r)] = self.reward_version(r) + 1
+        assert r.take(sparse_entries(fv)[0]).max() <= 1.0
+
+    def reward_version(self, r):
+        """Return the number of in place modifications made to the reward function r."""
+        return self.reward_versions.get(id(r), 0)
+
+    def save(self, path, metadata=None):
+        """Write a checkpoint of everything the agent has learned, with the given JSON-serializable metadata, to the
+        directory at path (see imrl.agent.checkpoint)."""
+        checkpoint.save(self, path, metadata)
+
+    def load(self, path):
+        """Restore the checkpoint at path into this agent, which must be new and configured like the saved one, and
+        return the metadata saved with it. The option models are memory-mapped from the checkpoint's files."""
+        return checkpoint.load(self, path)
 
     def explore(self):
         self.vi.r = self.intrinsic
 
     def exploit(self, goal):
-        self.extrinsic = [self.fa.evaluate(goal)]
+        self.extrinsic = [dense(self.fa.evaluate(goal))]
         self.vi.r = self.extrinsic
 
     def evaluate_sample(self, state):
-        """Check if the given state should be added to the state sample set based on distance criterion (epsilon)."""
-        if isinstance(state, int):  # Just check set membership for discrete domains.
-            if state not in self.samples:
-                self.samples.append(state)
-                self.samples.sort(reverse=False)
-            return
+        """Check if the given state should be added to the state sample set based on distance criterion (epsilon).
+        Return the row in the sample feature matrix of the sample that stands for the state."""
+        row = self.samples.find(state)
+        if row is None:
+            row = self.sample_features.append(self.fa.evaluate(state))
+            self.samples.add(state, row)
+        return row
 
-        # TODO replace sample list with KD-tree
-        add = True
-        for s in self.samples:
-            if np.linalg.norm(np.asarray(s - state), 2) <= self.epsilon:
-                add = False
-                break
-        if add:
-            self.samples.append(state)
+    @property
+    def sample_rows(self):
+        return self.samples.rows
 
     def evaluate_subgoal(self, state):
         """Check whether the given state is a subgoal for an as yet uncreated option and create one if so."""
-        if isinstance(state, int):  # Just check set membership for discrete domains.
-            g = Subgoal(state)
-            if g in self.subgoals and g not in self.reached_subgoals:
-                self.create_option(g)
-                self.reached_subgoals.append(g)
-                # print('Subgoal reached: ' + str(g.state))
-            return
+        g = self.subgoals.reach(state)
+        if g is not None:
+            self.create_option(g)
 
-        for g in self.subgoals:
-            if np.linalg.norm(np.asarray(g.state - state), 2) <= g.radius and g not in self.reached_subgoals:
-                self.create_option(g)
-                self.reached_subgoals.append(g)
-                # print('Subgoal reached: ' + str(g.state) + ',  ' + str(g.radius))
-                break
+    @property
+    def reached_subgoals(self):
+        return self.subgoals.reached_subgoals()
 
     def create_option(self, subgoal):
         """Create a new option for the given subgoal with a pseudo reward function and value iteration policy."""
         id = len(self.options)
-        vi = ValueIteration(id, [self.fa.evaluate(subgoal.state)], self, self.plan_iterations, alpha=self.alpha, gamma=self.gamma)
+        vi = ValueIteration(id, [dense(self.fa.evaluate(subgoal.state))], self, self.plan_iterations, alpha=self.alpha, gamma=self.gamma,
+                            ordering=self.vi_ordering, tolerance=self.vi_tolerance,
+                            residual_norm=self.vi_residual_norm, budget=self.vi_budget)
+        vi.random = self.random
         policy = VIPolicy(self.num_actions, vi)
-        self.options[id] = Option(id, self.fa, policy, self.eta, self.gamma, subgoal, self.num_actions)
-        self.intrinsic.append(np.zeros((self.fa.num_features, 1)))
+        self.options[id] = Option(id, self.fa, policy, self.eta, self.gamma, subgoal, self.num_actions, storage=self.option_storage,
+                                  rank=self.option_rank, directory=self.option_dir)
+        self.stack_option(self.options[id])
+        self.intrinsic.append(np.zeros((self.fa.num_features, 1), dtype=self.fa.dtype))
+
+    def stack_option(self, o):
+        """Move the option's models into the model stack, if there is one."""
+        if self.model_stack is not None:
+            assert self.model_stack.add(o) == o.id, 'Options must be stacked in id order.'
+
+    def replay_transitions(self, batch_size):
+        """Replay a random mini-batch of stored primitive transitions, updating the models of each option in the batch
+        with one batched update of M and one of U."""
+        rows = self.replay.sample(batch_size)
+        options = self.replay.options[rows]
+        for o in np.unique(options).tolist():
+            o_rows = rows[options == o]
+            fm = self.replay.features(o_rows)
+            fm_prime = self.replay.features(o_rows, next_state=True)
+            self.options[o].update_m_batch(fm, fm_prime, 0)
+            self.options[o].update_u_batch(fm, fm_prime, self.replay.terminal[o_rows])
 
     def plan(self):
-        # Compute option policies
-        for i in range(self.num_actions, len(self.options)):
-            self.options[i].policy.vi.run()
+        if self.replay is not None and len(self.replay) > 0:
+            self.replay_transitions(self.replay_batch)
+        touched, self.touched_rows = self.touched_rows, set()
+        subgoal_options = [self.options[i] for i in range(self.num_actions, len(self.options))]
+        # An option that is not replanned keeps the touched rows as seeds for when it is
+        for o in subgoal_options:
+            o.pending_rows |= touched
+        if self.plan_threshold is not None:
+            subgoal_options = [o for o in subgoal_options if self.needs_planning(o)]
+        self.replanned = [o.id for o in subgoal_options]
+        logging.debug('Replanning options {}'.format(self.replanned))
+
+        if self.plan_workers > 0:
+            # Seeds are drawn in option order, so the results do not depend on the number of workers or their timing
+            seeds = [self.random.getrandbits(32) for _ in subgoal_options]
+            self.plan_forked(subgoal_options, seeds)
+        else:
+            # Compute option policies
+            for o in subgoal_options:
+                o.policy.vi.run(o.pending_rows)
+                o.pending_rows = set()
 
-        # Simulate option policies to learn option models
-        for i in range(self.num_actions, len(self.options)):
-            samples = self.options[i].get_init_set()
-            for s in random.sample(samples, min(self.sim_samples, len(samples))):
-                self.simulate_policy(self.options[i], s, self.sim_steps)
+            # Simulate option policies to learn option models
+            for o in subgoal_options:
+                self.simulate_option(o, self.random)
 
         # Compute base policy
-        self.vi.run()
+        self.vi.run(touched)
+
+        # Tabulate the greedy options at the samples for acting until the next plan
+        self.vi_policy.update_table()
+        for o in subgoal_options:
+            o.policy.update_table()
+            o.planned_total = self.dependency_total(o)
+            o.planned_rows = len(o.get_init_rows())
+        return self.replanned
+
+    def dependency_total(self, o):
+        """Return the total magnitude of the updates of the models that the planning of option o depends on: those of
+        the options its value iteration backs up over, and its own, which its simulations learn."""
+        return sum(self.options[i].update_total for i in o.policy.vi.option_ids()) + o.update_total
+
+    def planning_change(self, o):
+        """Return the magnitude of the model updates that the planning of option o depends on since it was last planned,
+        and the number of samples added to its init set since."""
+        return self.dependency_total(o) - o.planned_total, len(o.get_init_rows()) - o.planned_rows
+
+    def needs_planning(self, o):
+        """Return whether option o has never been planned, has new samples in its init set, or has model updates above
+        the plan threshold since it was last planned."""
+        magnitude, new_rows = self.planning_change(o)
+        return o.planned_rows < 0 or new_rows > 0 or magnitude > self.plan_threshold
+
+    def plan_option(self, o, rng):
+        """Compute the policy of the subgoal option o and simulate it to learn its models, drawing every random choice
+        from rng. This writes only to o's value function and models and reads those of the primitive actions, so the
+        options can be planned concurrently."""
+        previous, o.policy.vi.random = o.policy.vi.random, rng
+        try:
+            o.policy.vi.run(o.pending_rows)
+            o.pending_rows = set()
+            self.simulate_option(o, rng)
+        finally:
+            o.policy.vi.random = previous
+
+    def plan_forked(self, options, seeds):
+        """Plan the options as plan_option does, each with a random.Random seeded with its seed, in plan_workers
+        processes forked from the agent, and take over what they learned."""
+        with ProcessPoolExecutor(min(self.plan_workers, len(options)), mp_context=multiprocessing.get_context('fork'),
+                                 initializer=set_forked_agent, initargs=(self,)) as pool:
+            for o, state in zip(options, pool.map(plan_forked_option, [o.id for o in options], seeds)):
+                self.load_planning_state(o, state)
+
+    def planning_state(self, o):
+        """Return what planning changes of option o: the state of its value iteration and its models. Memory-mapped
+        models are shared with the forked processes and left out."""
+        vi = o.policy.vi
+        return {'theta': vi.theta, 'residuals': vi.residuals, 'version': vi.version, 'queue': vi.queue,
+                'priorities': vi.priorities, 'eligible': vi.eligible, 'update_total': o.update_total,
+                'u_version': o.u_version,
+                'models': [None if getattr(model, 'filename', None) else model.arrays() for model in [o.m_model, o.u_model]]}
+
+    def load_planning_state(self, o, state):
+        """Restore the planning state of option o returned by planning_state. Dense models are written in place, so
+        that they stay in the model stack."""
+        vi = o.policy.vi
+        vi.theta, vi.residuals, vi.version = state['theta'], state['residuals'], state['version']
+        vi.queue, vi.priorities, vi.eligible = state['queue'], state['priorities'], state['eligible']
+        o.update_total, o.u_version = state['update_total'], state['u_version']
+        o.pending_rows = set()
+        for model, arrays in zip([o.m_model, o.u_model], state['models']):
+            if arrays is None:
+                continue
+            if isinstance(model, DenseModel) and model.in_place:
+                model.matrix[...] = arrays['matrix']
+            else:
+                model.load_arrays(arrays)
+
+    def simulate_option(self, o, rng):
+        """Simulate option o's policy from sim_samples of its start samples, drawn with rng, to learn its models."""
+        if self.sim_batched:
+            rows = o.get_init_rows()
+            self.simulate_policy_batch(o, rng.sample(rows, min(self.sim_samples, len(rows))), self.sim_steps)
+            return
+        samples = o.get_init_set()
+        for s in rng.sample(samples, min(self.sim_samples, len(samples))):
+            self.simulate_policy(o, s, self.sim_steps)
 
     def simulate_policy(self, o, start, steps):
         """Simulates an option's policy to provide data for learning M and U.
@@ -169,4 +388,54 @@ class Agent:
                     o.update_m(state, s_prime, len(trajectory) - t - 1)
                 break
             trajectory.append(s_prime)
-            s = s_prime
\ No newline at end of file
+            s = s_prime
+
+    def simulate_policy_batch(self, o, rows, steps):
+        """Simulate an option's policy from the samples at the given rows of the sample feature matrix together, with
+        batched action selection and batched updates of U and M."""
+        if not rows:
+            return
+        fm = self.sample_features.matrix[rows]
+        running = np.arange(len(rows))
+        # The feature matrices of the steps taken so far, and the indices of the simulations running in each
+        trajectory = []
+        for step in range(steps):
+            actions = o.policy.choose_actions_from_fm(fm)
+            x_prime = np.empty((len(running), self.fa.num_features), dtype=self.fa.dtype)
+            for a in np.unique(actions).tolist():
+                chosen = np.flatnonzero(actions == a)
+                x_prime[chosen] = self.options[a].m_model.dot_batch(fm[chosen])
+            fm_prime = scipy.sparse.csr_matrix(x_prime)
+            terminal = o.is_terminal_batch(x_prime)
+            o.update_u_batch(fm, fm_prime, terminal, per_feature=True)
+            trajectory.append((fm, running))
+            if np.any(terminal):
+                terminated = running[terminal]
+                states, successors, tau = [], [], []
+                for t, (fm_t, running_t) in enumerate(trajectory):
+                    # The simulations running at step t include those terminating now, in the same order
+                    states.append(fm_t[np.flatnonzero(np.isin(running_t, terminated))])
+                    successors.append(fm_prime[np.flatnonzero(terminal)])
+                    tau.append(np.full(len(terminated), step - t))
+                o.update_m_batch(scipy.sparse.vstack(states, format='csr'), scipy.sparse.vstack(successors, format='csr'),
+                                 np.concatenate(tau), per_feature=True)
+            if np.all(terminal):
+                break
+            running = running[~terminal]
+            fm = fm_prime[np.flatnonzero(~terminal)]
+
+
+# The agent that planning processes were forked from (see Agent.plan_forked)
+forked_agent = None
+
+
+def set_forked_agent(agent):
+    global forked_agent
+    forked_agent = agent
+
+
+def plan_forked_option(id, seed):
+    """Plan option id of the agent the process was forked from and return its planning state."""
+    o = forked_agent.options[id]
+    forked_agent.plan_option(o, random.Random(seed))
+    return forked_agent.planning_state(o)
@@ -69,18 +69,14 @@ class AgentViz:
     def plot_reward(self, id):
         reward = np.amax(np.asarray(self.agent.vi_policy.vi.r), axis=0) if id == 0 \
             else self.agent.options[id + self.agent.num_actions - 1].policy.vi.r[0]  # self.agent.intrinsic[id + self.agent.num_actions - 1]
-        vals = []
-        for s in self.state_samples:
-            vals.append(np.dot(self.agent.fa.evaluate(s).T, reward))
+        vals = np.dot(self.agent.fa.evaluate_batch(self.state_samples), reward)[:, 0]
         self.subplots['reward'][id].cla()
         sc = self.subplots['reward'][id].scatter(self.grid_samples[:, 0], self.grid_samples[:, 1], s=180, c=vals, cmap='Greens')
         plt.colorbar(sc, cax=self.reward_divs[id])
 
     def plot_vf(self, id):
         theta = self.agent.vi_policy.vi.theta if id == 0 else self.agent.options[id + self.agent.num_actions - 1].policy.vi.theta
-        vals = []
-        for s in self.state_samples:
-            vals.append(np.dot(self.agent.fa.evaluate(s).T, theta))
+        vals = np.dot(self.agent.fa.evaluate_batch(self.state_samples), theta)[:, 0]
         self.subplots['vf'][id].cla()
         sc = self.subplots['vf'][id].scatter(self.grid_samples[:, 0], self.grid_samples[:, 1], s=180, c=vals, cmap='Greens')
         plt.colorbar(sc, cax=self.vf_divs[id])
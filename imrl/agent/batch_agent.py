@@ -0,0 +1,124 @@
+"""Independent agents of the same configuration updated in lockstep."""
+
+# Third party
+import numpy as np
+
+# First party
+from imrl.utils.linear_algebra import dense, sparse_entries
+
+
+class BatchAgent(object):
+    """K independent agents of the same configuration, with dense option models, whose per-step updates of the primitive
+    action models and intrinsic rewards are batched. Planning is not batched and stays per agent."""
+
+    def __init__(self, agents):
+        first = agents[0]
+        for agent in agents:
+            assert agent.model_stack is not None, 'Only agents with dense option models can be batched.'
+            assert (agent.fa.num_features, agent.num_actions, agent.fa.dtype) == \
+                (first.fa.num_features, first.num_actions, first.fa.dtype), 'The agents must share their configuration.'
+        self.agents = agents
+        self.num_actions = first.num_actions
+        n = first.fa.num_features
+        # Every subgoal creates at most one option, so the stacks are allocated for all of them and never grow
+        capacity = max(len(agent.model_stack.m_t) for agent in agents)
+        self.m_t = np.zeros((len(agents), capacity, n, n), dtype=first.fa.dtype)
+        self.u_t = np.zeros((len(agents), capacity, n, n), dtype=first.fa.dtype)
+        self.intrinsic_t = np.stack([np.stack(agent.intrinsic[:self.num_actions]) for agent in agents])
+        for k, agent in enumerate(agents):
+            agent.model_stack.move_to(self.m_t[k], self.u_t[k])
+            agent.intrinsic[:self.num_actions] = list(self.intrinsic_t[k])
+        # The last state evaluated for each agent and its feature vector, which is reused until the agent moves on
+        self.last = [(None, None)] * len(agents)
+
+    def __len__(self):
+        return len(self.agents)
+
+    def evaluate(self, ks, states):
+        """Return the feature vectors of the states of agents ks. An agent's last evaluated state is not evaluated again,
+        and the other states are evaluated in one batch by the first agent's function approximator, whose configuration
+        all of the agents share."""
+        fvs = [self.last[k][1] if s is self.last[k][0] else None for k, s in zip(ks, states)]
+        missing = [j for j, fv in enumerate(fvs) if fv is None]
+        if missing:
+            for j, fv in zip(missing, self.agents[0].fa.evaluate_each([states[j] for j in missing])):
+                fvs[j] = fv
+        for k, s, fv in zip(ks, states, fvs):
+            self.last[k] = (s, fv)
+        return fvs
+
+    def choose_actions(self, states, ks=None):
+        """Return the actions that agents ks, by default every agent, choose in their states, as Agent.choose_action
+        does."""
+        ks = list(range(len(self.agents))) if ks is None else ks
+        return [self.agents[k].choose_action_from_fv(fv) for k, fv in zip(ks, self.evaluate(ks, states))]
+
+    def update(self, states, actions, states_prime, ks=None):
+        """Update agent ks[j], by default every agent, with its transition (states[j], actions[j], states_prime[j]), as
+        Agent.update does."""
+        ks = list(range(len(self.agents))) if ks is None else ks
+        fvs = self.evaluate(ks, states)
+        fvs_prime = self.evaluate(ks, states_prime)
+        # Agents that only execute the primitive action, which terminates, update only its models
+        batched = [j for j, k in enumerate(ks) if len(self.agents[k].option_stack) == 1]
+        for j, k in enumerate(ks):
+            if len(self.agents[k].option_stack) > 1:
+                self.agents[k].update_options(actions[j], states_prime[j], fvs[j], fvs_prime[j])
+        if batched:
+            self.update_primitives([ks[j] for j in batched], [actions[j] for j in batched],
+                                   [fvs[j] for j in batched], [fvs_prime[j] for j in batched])
+        for j, k in enumerate(ks):
+            self.agents[k].observe(states[j], actions[j], fvs[j], fvs_prime[j])
+            assert self.agents[k].model_stack.m_t.base is self.m_t, 'The model stack of agent {} has grown.'.format(k)
+        if batched:
+            self.update_intrinsic_rewards([ks[j] for j in batched], [actions[j] for j in batched], [fvs[j] for j in batched])
+        unbatched = set(range(len(ks))) - set(batched)
+        for j, k in enumerate(ks):
+            if j in unbatched:
+                self.agents[k].update_intrinsic_reward(states[j], actions[j])
+            self.agents[k].step += 1
+
+    def entries(self, fvs):
+        """Return the (B, w) arrays of the indices and values of the nonzero entries of B feature vectors, padded with
+        zero values at index 0 to the largest number w of nonzero entries."""
+        entries = [sparse_entries(fv) for fv in fvs]
+        width = max(len(indices) for indices, _ in entries)
+        indices = np.zeros((len(fvs), width), dtype=int)
+        values = np.zeros((len(fvs), width), dtype=self.m_t.dtype)
+        for i, (fv_indices, fv_values) in enumerate(entries):
+            indices[i, :len(fv_indices)] = fv_indices
+            values[i, :len(fv_values)] = fv_values
+        return indices, values
+
+    def update_primitives(self, ks, actions, fvs, fvs_prime):
+        """Make the update_m and terminal update_u of the primitive action taken by each agent ks[j], and pop it off the
+        agent's option stack. With the transposed models X = M^T in the stacks, M fv is the sum of the rows of X at the
+        nonzero features, weighted by their values, and the update eta * delta fv^T adds eta * value * delta to each of
+        those rows."""
+        for k, a in zip(ks, actions):
+            o_idx, _, start = self.agents[k].option_stack.pop()
+            assert o_idx == a and self.agents[k].step == start
+        indices, values = self.entries(fvs)
+        rows = (np.asarray(ks)[:, np.newaxis], np.asarray(actions)[:, np.newaxis], indices)
+        x = np.stack([dense(fv)[:, 0] for fv in fvs])
+        x_prime = np.stack([dense(fv)[:, 0] for fv in fvs_prime])
+        eta = self.agents[0].eta
+        fv_norms = np.linalg.norm(values, axis=1)
+        for stack, target in [(self.m_t, x_prime), (self.u_t, x)]:
+            delta = target - np.einsum('bw,bwn->bn', values, stack[rows])
+            np.add.at(stack, rows, (eta * values)[:, :, np.newaxis] * delta[:, np.newaxis, :])
+            for k, a, update_norm in zip(ks, actions, eta * np.linalg.norm(delta, axis=1) * fv_norms):
+                self.agents[k].options[a].update_total += update_norm
+        for k, a in zip(ks, actions):
+            self.agents[k].options[a].u_version += 1
+
+    def update_intrinsic_rewards(self, ks, actions, fvs):
+        """Make the intrinsic reward update of Agent.update_intrinsic_reward for the action taken by each agent ks[j]."""
+        indices, values = self.entries(fvs)
+        rows = (np.asarray(ks)[:, np.newaxis], np.asarray(actions)[:, np.newaxis], indices, 0)
+        zeta = self.agents[0].zeta
+        rewards = np.sum(values * self.intrinsic_t[rows], axis=1)
+        np.add.at(self.intrinsic_t, rows, (-zeta * rewards)[:, np.newaxis] * values)
+        for k, a in zip(ks, actions):
+            r = self.agents[k].intrinsic[a]
+            self.agents[k].reward_versions[id(r)] = self.agents[k].reward_version(r) + 1
@@ -0,0 +1,149 @@
+"""Checkpoints of the learned state of an agent: a directory of .npy arrays and a meta.json file, with no pickled
+objects. The model arrays are memory-mapped copy-on-write on loading."""
+
+# System
+import heapq
+import json
+import os
+import shutil
+
+# Third party
+import numpy as np
+
+# First party
+from imrl.utils.linear_algebra import dense
+
+FORMAT_VERSION = 2
+REPLAY_ARRAYS = ['options', 'terminal', 'indices', 'values']
+
+
+def save(agent, path, metadata=None):
+    """Write a checkpoint of the agent to the directory at path. The checkpoint is written next to path and then moved
+    into place, so an interrupted save leaves the previous checkpoint intact."""
+    temporary = path.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+
+    def write(name, array):
+        np.save(os.path.join(temporary, name + '.npy'), array)
+
+    subgoal_ids = list(range(agent.num_actions, len(agent.options)))
+    vis = [agent.vi] + [agent.options[i].policy.vi for i in subgoal_ids]
+    order = np.argsort(agent.sample_rows, kind='stable')
+    write('samples', np.asarray([agent.samples[i] for i in order]))
+    write('theta', np.stack([vi.theta for vi in vis]))
+    write('queue_rows', np.asarray([row for vi in vis for row in vi.priorities], dtype=int))
+    write('queue_priorities', np.asarray([priority for vi in vis for priority in vi.priorities.values()], dtype=float))
+    write('eligible', np.concatenate([vi.eligible for vi in vis]))
+    write('intrinsic', np.stack(agent.intrinsic))
+    if agent.model_stack is not None:
+        write('m_t', agent.model_stack.m_t[:len(agent.options)])
+        write('u_t', agent.model_stack.u_t[:len(agent.options)])
+    else:
+        for i, o in agent.options.items():
+            for prefix, model in [('m', o.m_model), ('u', o.u_model)]:
+                for name, array in model.arrays().items():
+                    write('{}{}_{}'.format(prefix, i, name), array)
+    option_fvs = np.zeros((len(agent.option_stack), agent.fa.num_features), dtype=agent.fa.dtype)
+    for k, (_, fv, _) in enumerate(agent.option_stack):
+        option_fvs[k] = dense(fv)[:, 0]
+    write('option_stack', option_fvs)
+    random_state = agent.random.getstate()
+    numpy_state = agent.np_random.get_state()
+    write('numpy_random_keys', numpy_state[1])
+    if agent.replay is not None:
+        for name in REPLAY_ARRAYS:
+            write('replay_' + name, getattr(agent.replay, name))
+
+    meta = {
+        'version': FORMAT_VERSION,
+        'num_features': agent.fa.num_features,
+        'num_actions': agent.num_actions,
+        'dtype': agent.fa.dtype.name,
+        'option_storage': agent.option_storage,
+        'discrete_samples': agent.samples.discrete,
+        'reached_subgoals': [int(i) for i in agent.subgoals.reached_order],
+        'step': agent.step,
+        'update_totals': [agent.options[i].update_total for i in range(len(agent.options))],
+        'planned': [[agent.options[i].planned_total, agent.options[i].planned_rows] for i in subgoal_ids],
+        'touched_rows': sorted(agent.touched_rows),
+        'pending_rows': [sorted(agent.options[i].pending_rows) for i in subgoal_ids],
+        'queue_lengths': [len(vi.priorities) for vi in vis],
+        'eligible_lengths': [len(vi.eligible) for vi in vis],
+        'option_stack': [[int(o), int(start)] for o, _, start in agent.option_stack],
+        'random_state': [random_state[0], list(random_state[1]), random_state[2]],
+        'numpy_random_state': [numpy_state[0], int(numpy_state[2]), int(numpy_state[3]), float(numpy_state[4])],
+        'replay': None if agent.replay is None else [agent.replay.size, agent.replay.position],
+        'metadata': metadata,
+    }
+    with open(os.path.join(temporary, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(temporary, path)
+
+
+def load(agent, path):
+    """Restore the checkpoint at path into an agent freshly created with the configuration it was saved from, and
+    return the metadata saved with it."""
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    def read(name, mmap_mode=None):
+        return np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+
+    assert meta['version'] == FORMAT_VERSION, 'Unknown checkpoint format {}'.format(meta['version'])
+    assert (meta['num_features'], meta['num_actions'], meta['dtype'], meta['option_storage']) == \
+        (agent.fa.num_features, agent.num_actions, agent.fa.dtype.name, agent.option_storage), \
+        'The checkpoint was saved from an agent with a different configuration.'
+    assert len(agent.options) == agent.num_actions and len(agent.samples) == 0, 'Checkpoints load into new agents only.'
+
+    for s in read('samples'):
+        agent.evaluate_sample(int(s) if meta['discrete_samples'] else s)
+    for i in meta['reached_subgoals']:
+        agent.create_option(agent.subgoals.mark_reached(i))
+
+    if agent.model_stack is not None:
+        agent.model_stack.load(read('m_t', 'c'), read('u_t', 'c'))
+    else:
+        names = sorted(os.listdir(path))
+        for i, o in agent.options.items():
+            for prefix, model in [('m', o.m_model), ('u', o.u_model)]:
+                start = '{}{}_'.format(prefix, i)
+                model.load_arrays({name[len(start):-4]: read(name[:-4], 'c') for name in names if name.startswith(start)})
+    for o, update_total in zip(agent.options.values(), meta['update_totals']):
+        o.update_total = update_total
+        o.u_version += 1  # Invalidates the cached reward projections
+
+    subgoal_ids = list(range(agent.num_actions, len(agent.options)))
+    for i, (planned_total, planned_rows), pending_rows in zip(subgoal_ids, meta['planned'], meta['pending_rows']):
+        agent.options[i].planned_total = planned_total
+        agent.options[i].planned_rows = planned_rows
+        agent.options[i].pending_rows = set(pending_rows)
+    agent.touched_rows = set(meta['touched_rows'])
+
+    vis = [agent.vi] + [agent.options[i].policy.vi for i in subgoal_ids]
+    queue_ends = np.cumsum(meta['queue_lengths'])
+    eligible_ends = np.cumsum(meta['eligible_lengths'])
+    queue_rows, queue_priorities, eligible = read('queue_rows'), read('queue_priorities'), read('eligible')
+    for k, (vi, theta) in enumerate(zip(vis, read('theta'))):
+        vi.theta = theta.copy()
+        vi.version += 1  # Invalidates the tabulated greedy policies
+        queued = slice(queue_ends[k] - meta['queue_lengths'][k], queue_ends[k])
+        vi.priorities = dict(zip(queue_rows[queued].tolist(), queue_priorities[queued].tolist()))
+        vi.queue = [(-priority, row) for row, priority in vi.priorities.items()]
+        heapq.heapify(vi.queue)
+        vi.eligible = eligible[eligible_ends[k] - meta['eligible_lengths'][k]:eligible_ends[k]].copy()
+    agent.intrinsic[:] = list(read('intrinsic').copy())
+    agent.step = meta['step']
+    agent.option_stack = [(o, fv[:, np.newaxis], start) for (o, start), fv in zip(meta['option_stack'], read('option_stack'))]
+    if agent.replay is not None and meta['replay'] is not None:
+        for name in REPLAY_ARRAYS:
+            setattr(agent.replay, name, read('replay_' + name).copy())
+        agent.replay.size, agent.replay.position = meta['replay']
+
+    version, internal, gauss = meta['random_state']
+    agent.random.setstate((version, tuple(internal), gauss))
+    name, position, has_gauss, cached_gaussian = meta['numpy_random_state']
+    agent.np_random.set_state((name, read('numpy_random_keys'), position, has_gauss, cached_gaussian))
+    return meta['metadata']
@@ -0,0 +1,72 @@
+"""Caching function approximator. Memoizes the feature vectors of recently evaluated states."""
+
+# System
+import threading
+from collections import OrderedDict
+
+# Third party
+import numpy as np
+
+# First party
+from imrl.agent.fa.func_approx import FunctionApproximator
+
+
+class CachedFA(FunctionApproximator):
+    """Wraps a function approximator with an LRU cache of at most capacity feature vectors keyed on the state.
+    Int states are their own keys. Array states are keyed on their bytes or, if a quantum is given, on their coordinates
+    rounded to multiples of quantum, in which case all states in a cell share the first feature vector computed for it.
+    Cached feature vectors are shared between callers and must not be modified in place. Evaluation is thread safe."""
+
+    def __init__(self, fa, capacity=1024, quantum=None):
+        super(CachedFA, self).__init__(fa.num_features, fa.num_actions, fa.dtype)
+        self.fa = fa
+        self.capacity = capacity
+        self.quantum = quantum
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        """Expose the attributes of the wrapped function approximator, such as its dimensionality."""
+        if name == 'fa':
+            raise AttributeError(name)
+        return getattr(self.fa, name)
+
+    def key(self, s):
+        """Return the cache key of state s."""
+        if isinstance(s, (int, np.integer)):
+            return int(s)
+        s = np.asarray(s, dtype=float)
+        if self.quantum is not None:
+            s = np.round(s / self.quantum) + 0.0  # Adding 0.0 maps -0.0 to 0.0 so both share a key
+        return s.tobytes()
+
+    def evaluate(self, s):
+        key = self.key(s)
+        with self.lock:
+            fv = self.cache.get(key)
+            if fv is not None:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                return fv
+            self.misses += 1
+        fv = self.fa.evaluate(s)
+        with self.lock:
+            self.cache[key] = fv
+            if len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+        return fv
+
+    def evaluate_each(self, states):
+        return [self.evaluate(s) for s in states]
+
+    def evaluate_batch(self, states):
+        return self.fa.evaluate_batch(states)
+
+    def clear(self):
+        """Drop all cached feature vectors and reset the hit and miss counters."""
+        with self.lock:
+            self.cache.clear()
+            self.hits = 0
+            self.misses = 0
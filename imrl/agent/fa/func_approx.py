@@ -3,22 +3,40 @@
 # Third party
 import numpy as np
 
+# First party
+from imrl.utils.linear_algebra import StateActionVector
+
 
 class FunctionApproximator:
-    """Abstract function approximator class. Evaluates """
+    """Abstract function approximator class. Evaluates states to feature vectors of the given floating point dtype, which
+    the agent, its options and value iteration adopt for all of their arrays."""
 
-    def __init__(self, num_features, num_actions):
+    def __init__(self, num_features, num_actions, dtype=np.float64):
         self.num_features = num_features
         self.num_actions = num_actions
         self.size = num_features * num_actions
+        self.dtype = np.dtype(dtype)
+        assert self.dtype in (np.float32, np.float64), 'Unsupported dtype {}'.format(self.dtype)
 
     def evaluate(self, s):
         raise NotImplementedError("Should evaluate a state.")
 
+    def evaluate_batch(self, states):
+        """Compute the (N, num_features) feature matrix for a sequence of N states, one feature vector per row."""
+        fm = np.zeros((len(states), self.num_features), dtype=self.dtype)
+        for i, s in enumerate(states):
+            fm[i] = self.evaluate(s)[:, 0]
+        return fm
+
+    def evaluate_each(self, states):
+        """Return a list with the feature vector of each of the given states."""
+        return [row[:, np.newaxis] for row in self.evaluate_batch(states)]
+
     def evaluate_state_action(self, s, a):
-        raise NotImplementedError("Should evaluate a state-action pair.")
+        """Compute the feature vector for the given state-action pair, a view over the state's feature vector."""
+        assert a < self.num_actions
+        return self.augment_with_action(self.evaluate(s), a)
 
     def augment_with_action(self, fv, action):
-        sa_fv = [0] * self.num_actions
-        sa_fv[self.num_features * action:self.num_features*(action + 1)] = fv.tolist()
-        return np.asarray(sa_fv)
+        """Place the state feature vector fv in the block of the given action, a vector of length size that copies nothing."""
+        return StateActionVector(fv, action, self.num_actions)
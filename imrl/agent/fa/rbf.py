@@ -3,17 +3,20 @@
 # Third party
 import numpy as np
 from itertools import product
-from scipy.linalg import norm
+from scipy.spatial import cKDTree
 # First party
 from imrl.agent.fa.func_approx import FunctionApproximator
+from imrl.utils.linear_algebra import SparseVector
 
 
 class RBF(FunctionApproximator):
     """Radial basis function approximator. Creates n^d RBF kernels evenly spaced,
-    d is the dimensionality of the input space and n is the number of kernels along a single dimension (the resolution)"""
+    d is the dimensionality of the input space and n is the number of kernels along a single dimension (the resolution).
+    If a cutoff radius is given, kernels whose centers are further than cutoff from the state are truncated to 0 and
+    evaluate returns a SparseVector over the remaining centers, which are found through a KD-tree over the centers."""
 
-    def __init__(self, dim, resolution, num_actions, beta=40, min_val=0, max_val=1):
-        super(RBF, self).__init__(resolution ** dim, num_actions)
+    def __init__(self, dim, resolution, num_actions, beta=40, min_val=0, max_val=1, cutoff=None, dtype=np.float64):
+        super(RBF, self).__init__(resolution ** dim, num_actions, dtype)
         self.dim = dim
         self.min_val = min_val
         self.max_val = max_val
@@ -22,31 +25,37 @@ class RBF(FunctionApproximator):
         # Segment the space based on resolution
         segmentation = [np.linspace(min_val, max_val, resolution).tolist()] * dim
 
-        # Generate centers from Cartiesian product of segmentation lists
-        centers = product(*segmentation)
-        self.centers = [np.asarray(a) for a in centers]
-
-    def _evalulate_kernel(self, c, x):
-        """Evaluate an RBF kernel c at a given point x."""
-        return np.exp(-self.beta * norm(c - x, 2) ** 2)
+        # Generate centers from Cartiesian product of segmentation lists, one center per row
+        self.centers = np.asarray(list(product(*segmentation)))
+        self.center_sq_norms = np.sum(self.centers ** 2, axis=1)
+        self.cutoff = cutoff
+        self.center_index = cKDTree(self.centers) if cutoff is not None else None
+
+    def evaluate_batch(self, states):
+        """Compute the (N, num_features) feature matrix for N states given as an (N, dim) array.
+        Squared distances to every center are expanded as |x|^2 + |c|^2 - 2 x.c so all kernels are a single matmul.
+        Distances are computed in float64 and only the kernel values are cast to the feature dtype."""
+        states = np.asarray(states, dtype=float).reshape(-1, self.dim)
+        assert np.all(self.min_val <= states) and np.all(states <= self.max_val)
+        sq_dist = np.sum(states ** 2, axis=1)[:, np.newaxis] + self.center_sq_norms - 2 * np.dot(states, self.centers.T)
+        fm = np.exp(-self.beta * np.maximum(sq_dist, 0)).astype(self.dtype, copy=False)
+        if self.cutoff is not None:
+            fm[sq_dist > self.cutoff ** 2] = 0.0
+        return fm
 
     def evaluate(self, s):
         """Compute the feature vector for the given state."""
         assert len(s) == self.dim
-        for i in range(len(s)):
-            assert self.min_val <= s[i] <= self.max_val
-        fv = np.zeros((self.num_features, 1))
-        for ci, c in enumerate(self.centers):
-            fv[ci] = self._evalulate_kernel(c, s)
-        return fv
-
-    def evaluate_state_action(self, s, a):
-        """Compute the feature vector for the given state-action pair."""
-        assert len(s) == self.dim
-        assert a < self.num_actions
-        for i in range(len(s)):
-            assert self.min_val <= s[i] <= self.max_val
-        fv = np.zeros((self.size, 1))
-        for ci, c in enumerate(self.centers):
-            fv[self.num_features * a + ci] = self._evalulate_kernel(c, s)
-        return fv
\ No newline at end of file
+        if self.cutoff is None:
+            return self.evaluate_batch([s]).T
+        s = np.asarray(s, dtype=float)
+        assert np.all(self.min_val <= s) and np.all(s <= self.max_val)
+        indices = np.asarray(self.center_index.query_ball_point(s, self.cutoff, return_sorted=True), dtype=int)
+        sq_dist = np.sum((self.centers[indices] - s) ** 2, axis=1)
+        return SparseVector(indices, np.exp(-self.beta * sq_dist), self.num_features, self.dtype)
+
+    def evaluate_each(self, states):
+        """Return a list with the feature vector of each of the given states, sparse if truncated."""
+        if self.cutoff is None:
+            return super(RBF, self).evaluate_each(states)
+        return [self.evaluate(s) for s in states]
@@ -1,23 +1,30 @@
 """Tabular function approximator. Implements 1-to-1 mapping from states to features."""
 
+# Third party
+import numpy as np
+
 # First party
 from imrl.agent.fa.func_approx import FunctionApproximator
-from imrl.utils.linear_algebra import one_hot_vector
+from imrl.utils.linear_algebra import one_hot_vector, OneHotVector
 
 class TabularFA(FunctionApproximator):
+    """Unless dense is set, states are evaluated to OneHotVectors so that consumers apply updates as index operations."""
 
-    def __init__(self, num_states, num_actions):
-        super(TabularFA, self).__init__(num_states, num_actions)
+    def __init__(self, num_states, num_actions, dense=False, dtype=np.float64):
+        super(TabularFA, self).__init__(num_states, num_actions, dtype)
+        self.dense = dense
 
     def evaluate(self, s):
         assert isinstance(s, int), 'The input sample must be an int'
         assert self.num_features >= s >= 0, \
             'Given state {} with num_states {} is not possible'.format(s, self.num_features)
-        return one_hot_vector(self.num_features, s)
+        return one_hot_vector(self.num_features, s, self.dtype) if self.dense else OneHotVector(s, self.num_features, self.dtype)
 
-    def evaluate_state_action(self, s, a):
-        """Create a one-hot vector for the given state-action pair."""
-        assert isinstance(s, int), 'The input sample must be an int'
-        assert self.num_features >= s >= 0, \
-            'Given state {} with num_states {} is not possible'.format(s, self.num_features)
-        return one_hot_vector(self.size, self.num_features * a + s)
\ No newline at end of file
+    def evaluate_each(self, states):
+        return [self.evaluate(s) for s in states]
+
+    def evaluate_batch(self, states):
+        """Create an (N, num_states) matrix whose rows are the one-hot vectors of the given states."""
+        fm = np.zeros((len(states), self.num_features), dtype=self.dtype)
+        fm[np.arange(len(states)), np.asarray(states, dtype=int)] = 1.0
+        return fm
@@ -0,0 +1,61 @@
+"""Tile coding function approximator."""
+
+# Third party
+import numpy as np
+# First party
+from imrl.agent.fa.func_approx import FunctionApproximator
+from imrl.utils.linear_algebra import SparseVector
+
+
+class TileCoding(FunctionApproximator):
+    """Tile coding approximator. Overlays num_tilings grids of resolution^d tiles on the d-dimensional input space, each
+    offset by a different fraction of a tile width, so every state activates exactly one binary feature per tiling.
+    Each tiling owns a block of features. Without a memory_size every tile gets its own feature, otherwise the tile
+    coordinates are hashed into memory_size // num_tilings features per tiling."""
+
+    def __init__(self, dim, resolution, num_tilings, num_actions, min_val=0, max_val=1, memory_size=None, dtype=np.float64):
+        tiles_per_tiling = (resolution + 1) ** dim if memory_size is None else memory_size // num_tilings
+        assert tiles_per_tiling > 0, 'memory_size must allow at least one feature per tiling'
+        super(TileCoding, self).__init__(num_tilings * tiles_per_tiling, num_actions, dtype)
+        self.dim = dim
+        self.resolution = resolution
+        self.num_tilings = num_tilings
+        self.min_val = min_val
+        self.max_val = max_val
+        self.hashed = memory_size is not None
+        self.tiles_per_tiling = tiles_per_tiling
+        self.tile_width = (max_val - min_val) / resolution
+
+        # Displace tiling i by i/num_tilings of a tile width times an odd number that differs per dimension, so the
+        # tilings are not all shifted along the diagonal
+        displacement = np.outer(np.arange(num_tilings), 2 * np.arange(dim) + 1) / num_tilings % 1
+        self.offsets = displacement * self.tile_width
+        self.tiling_starts = np.arange(num_tilings) * tiles_per_tiling
+        self.strides = (resolution + 1) ** np.arange(dim)
+        self.hash_multipliers = np.random.RandomState(0).randint(1, 2 ** 31, size=dim)
+
+    def tile_indices(self, s):
+        """Return the num_tilings feature indices of the tiles containing state s, one per tiling."""
+        s = np.asarray(s, dtype=float)
+        assert len(s) == self.dim
+        assert np.all(self.min_val <= s) and np.all(s <= self.max_val)
+        coordinates = np.floor((s - self.min_val + self.offsets) / self.tile_width).astype(np.int64)
+        if self.hashed:
+            tiles = np.dot(coordinates, self.hash_multipliers) % self.tiles_per_tiling
+        else:
+            tiles = np.dot(coordinates, self.strides)
+        return self.tiling_starts + tiles
+
+    def evaluate(self, s):
+        """Compute the sparse binary feature vector for the given state."""
+        return SparseVector(self.tile_indices(s), np.ones(self.num_tilings), self.num_features, self.dtype)
+
+    def evaluate_each(self, states):
+        return [self.evaluate(s) for s in states]
+
+    def evaluate_batch(self, states):
+        """Compute the (N, num_features) binary feature matrix for N states."""
+        fm = np.zeros((len(states), self.num_features), dtype=self.dtype)
+        for i, s in enumerate(states):
+            fm[i, self.tile_indices(s)] = 1.0
+        return fm
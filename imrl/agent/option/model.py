@@ -0,0 +1,315 @@
+"""Storage backends for the n x n matrices M and U of a universal option model. add_outer returns the updated array for
+dense storage and the backend itself otherwise, and the batch methods take feature vectors as the rows of a csr matrix."""
+
+# Third party
+import numpy as np
+import scipy.sparse
+
+# First party
+from imrl.utils.linear_algebra import sparse_entries, dense, inner, matvec, add_scaled, add_outer, relax, blas_function
+
+
+def create_model(storage, n, identity=False, in_place=True, rank=20, dtype=np.float64, filename=None):
+    """Create an n x n option model matrix of the given dtype, zero or the identity, stored in the given backend. The
+    memmap storage keeps the matrix in the file at filename."""
+    assert storage in ('dense', 'sparse', 'low_rank', 'memmap'), 'Unknown option model storage {}'.format(storage)
+    assert (storage == 'memmap') == (filename is not None), 'Only memmap storage, and all of it, needs a filename.'
+    return (storage in ('dense', 'memmap') and DenseModel(n, identity, in_place, dtype, filename)) or \
+           (storage == 'sparse' and SparseModel(n, identity, dtype=dtype)) or \
+           (storage == 'low_rank' and LowRankModel(n, identity, rank, dtype))
+
+
+def nonzeros(fv):
+    """Iterate over the (index, value) pairs of the nonzero entries of a feature vector."""
+    indices, values = sparse_entries(fv)
+    return zip(indices.tolist(), values.tolist())
+
+
+class DenseModel(object):
+    """Dense column-major array. Unless in_place is set, every update replaces the array with an updated copy.
+    If a filename is given, the array is a memory-mapped .npy file, created or overwritten, which is sparse on disk
+    until written, and which is always updated in place."""
+
+    def __init__(self, n, identity=False, in_place=True, dtype=np.float64, filename=None):
+        assert in_place or filename is None, 'Memory-mapped models are updated in place.'
+        if filename is not None:
+            self.matrix = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=(n, n), fortran_order=True)
+            if identity:
+                np.fill_diagonal(self.matrix, 1.0)
+        else:
+            self.matrix = np.eye(n, dtype=dtype, order='F') if identity else np.zeros((n, n), dtype=dtype, order='F')
+        self.in_place = in_place
+        self.filename = filename
+
+    def dot(self, fv, out=None):
+        return matvec(self.matrix, fv, out)
+
+    def tdot(self, x):
+        return np.dot(self.matrix.T, x)
+
+    def columns_at(self, indices):
+        return scipy.sparse.csr_matrix(self.matrix[:, indices].T)
+
+    def add_outer(self, x, fv, scale):
+        if not self.in_place:
+            self.matrix = self.matrix.copy(order='F')
+        return add_outer(self.matrix, x, fv, scale)
+
+    def relax_column(self, index, fv, scale, rate):
+        """Move column index toward scale * fv by the fraction rate in place, as add_outer does with the difference and a
+        one-hot vector at index, and return the norm of the difference."""
+        return relax(self.matrix[:, index], fv, scale, rate)
+
+    def dot_batch(self, fm):
+        return np.asarray(fm.dot(self.matrix.T))
+
+    def add_outer_batch(self, x, fm, scale):
+        """Only the columns at the nonzero features of the batch are touched. If the batch touches every column, the
+        update is a single BLAS gemm into the (column-major) matrix."""
+        if not self.in_place:
+            self.matrix = self.matrix.copy(order='F')
+        columns = np.unique(fm.indices)
+        if len(columns) == self.matrix.shape[1] and self.matrix.flags.f_contiguous:
+            blas_function('gemm', self.matrix)(scale, x, fm.toarray(), beta=1.0, c=self.matrix, trans_a=1, overwrite_c=True)
+        else:
+            self.matrix[:, columns] += scale * fm.tocsc()[:, columns].T.dot(x).T
+        return self.matrix
+
+    def to_dense(self):
+        return self.matrix
+
+    def arrays(self):
+        return {'matrix': self.matrix}
+
+    def load_arrays(self, arrays):
+        if self.filename is not None:
+            self.matrix[...] = arrays['matrix']
+        else:
+            self.matrix = arrays['matrix']
+
+
+class SparseModel(object):
+    """scipy.sparse lil_matrix holding the transpose, so that every column of the matrix is a row list that is read and
+    written in time proportional to the number of its nonzero entries. Entries with magnitude below tolerance are
+    dropped, so in tabular domains only the columns of visited states fill in. Products with the whole matrix read a csr
+    copy of it, which is kept until the next update."""
+
+    def __init__(self, n, identity=False, tolerance=1e-10, dtype=np.float64):
+        self.n = n
+        self.dtype = np.dtype(dtype)
+        self.columns = scipy.sparse.identity(n, dtype=dtype, format='lil') if identity else scipy.sparse.lil_matrix((n, n), dtype=dtype)
+        self.tolerance = tolerance
+        self.csr = None
+
+    def columns_csr(self):
+        """Return the csr form of the transposed matrix."""
+        if self.csr is None:
+            self.csr = self.columns.tocsr()
+        return self.csr
+
+    @property
+    def matrix(self):
+        return self.columns.T.tocsc()
+
+    def column(self, j):
+        """Return column j of the matrix as a dense 1-d array."""
+        column = np.zeros(self.n, dtype=self.dtype)
+        column[self.columns.rows[j]] = self.columns.data[j]
+        return column
+
+    def dot(self, fv, out=None):
+        if out is None:
+            out = np.zeros((self.n, 1), dtype=self.dtype)
+        else:
+            out.fill(0.0)
+        for j, v in nonzeros(fv):
+            out[self.columns.rows[j], 0] += v * np.asarray(self.columns.data[j])
+        return out
+
+    def tdot(self, x):
+        return self.columns_csr().dot(x)
+
+    def columns_at(self, indices):
+        return self.columns_csr()[indices]
+
+    def add_outer(self, x, fv, scale):
+        self.csr = None
+        for j, v in nonzeros(fv):
+            column = self.column(j)
+            column += (scale * v) * x[:, 0]
+            keep = np.flatnonzero(np.abs(column) > self.tolerance)
+            self.columns.rows[j] = keep.tolist()
+            self.columns.data[j] = column[keep].tolist()
+        return self
+
+    def dot_batch(self, fm):
+        return fm.dot(self.columns_csr()).toarray()
+
+    def add_outer_batch(self, x, fm, scale):
+        self.csr = None
+        columns = np.unique(fm.indices)
+        updates = fm.tocsc()[:, columns].T.dot(x)
+        for j, update in zip(columns.tolist(), updates):
+            column = self.column(j)
+            column += scale * update
+            keep = np.flatnonzero(np.abs(column) > self.tolerance)
+            self.columns.rows[j] = keep.tolist()
+            self.columns.data[j] = column[keep].tolist()
+        return self
+
+    def to_dense(self):
+        return self.columns.toarray().T
+
+    def arrays(self):
+        columns = self.columns_csr()
+        return {'data': columns.data, 'indices': columns.indices, 'indptr': columns.indptr}
+
+    def load_arrays(self, arrays):
+        columns = scipy.sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=(self.n, self.n))
+        self.columns = columns.tolil()
+        self.csr = None
+
+
+class LowRankModel(object):
+    """Factored matrix base * I + L R^T, where base is 1 for an identity-initialized matrix and 0 otherwise. Each rank-1
+    update appends a column to L and R. Once 2 * rank columns are used, L R^T is recompressed to its best rank `rank`
+    approximation, so memory is O(n * rank) and products cost O(n * rank)."""
+
+    def __init__(self, n, identity=False, rank=20, dtype=np.float64):
+        self.n = n
+        self.base = 1.0 if identity else 0.0
+        self.rank = rank
+        self.left = np.zeros((n, 2 * rank), dtype=dtype)
+        self.right = np.zeros((n, 2 * rank), dtype=dtype)
+        self.count = 0
+
+    @property
+    def matrix(self):
+        return self.to_dense()
+
+    def dot(self, fv, out=None):
+        result = np.dot(self.left[:, :self.count], inner(self.right[:, :self.count], fv), out=out)
+        return add_scaled(result, fv, self.base) if self.base else result
+
+    def tdot(self, x):
+        result = np.dot(self.right[:, :self.count], np.dot(self.left[:, :self.count].T, x))
+        return result + self.base * x if self.base else result
+
+    def columns_at(self, indices):
+        columns = np.dot(self.right[indices, :self.count], self.left[:, :self.count].T)
+        columns[np.arange(len(indices)), indices] += self.base
+        return scipy.sparse.csr_matrix(columns)
+
+    def add_outer(self, x, fv, scale):
+        if self.count == self.left.shape[1]:
+            self.compress()
+        self.left[:, self.count] = scale * x[:, 0]
+        self.right[:, self.count] = dense(fv)[:, 0]
+        self.count += 1
+        return self
+
+    def dot_batch(self, fm):
+        result = np.dot(fm.dot(self.right[:, :self.count]), self.left[:, :self.count].T)
+        return result + self.base * fm.toarray() if self.base else result
+
+    def add_outer_batch(self, x, fm, scale):
+        """Appends one factor column per row of the batch, recompressing whenever the factors fill up."""
+        for x_row, fm_row in zip(x, fm.toarray()):
+            if self.count == self.left.shape[1]:
+                self.compress()
+            self.left[:, self.count] = scale * x_row
+            self.right[:, self.count] = fm_row
+            self.count += 1
+        return self
+
+    def compress(self):
+        """Replace the factors by the truncated SVD of L R^T, computed from the QR decompositions of L and R."""
+        q_left, r_left = np.linalg.qr(self.left[:, :self.count])
+        q_right, r_right = np.linalg.qr(self.right[:, :self.count])
+        w, s, vt = np.linalg.svd(np.dot(r_left, r_right.T))
+        rank = min(self.rank, len(s))
+        self.left[:, :rank] = np.dot(q_left, w[:, :rank] * s[:rank])
+        self.right[:, :rank] = np.dot(q_right, vt[:rank].T)
+        self.left[:, rank:] = 0.0
+        self.right[:, rank:] = 0.0
+        self.count = rank
+
+    def to_dense(self):
+        return self.base * np.eye(self.n, dtype=self.left.dtype) + np.dot(self.left[:, :self.count], self.right[:, :self.count].T)
+
+    def arrays(self):
+        return {'left': self.left[:, :self.count], 'right': self.right[:, :self.count]}
+
+    def load_arrays(self, arrays):
+        self.count = arrays['left'].shape[1]
+        self.left[:, :self.count] = arrays['left']
+        self.right[:, :self.count] = arrays['right']
+        self.left[:, self.count:] = 0.0
+        self.right[:, self.count:] = 0.0
+
+
+class ModelStack(object):
+    """Keeps the dense M and U matrices of a set of options in two contiguous (capacity, n, n) arrays, so that products
+    with every option's model are single batched operations. Slice i holds the transpose of the i-th added option's
+    matrix, and that option's DenseModel array is the (column-major) transposed view of the slice. When the capacity
+    is exceeded both arrays are doubled and every view is re-pointed."""
+
+    def __init__(self, n, capacity=8, dtype=np.float64):
+        self.n = n
+        self.dtype = np.dtype(dtype)
+        self.m_t = np.zeros((capacity, n, n), dtype=dtype)
+        self.u_t = np.zeros((capacity, n, n), dtype=dtype)
+        self.options = []
+
+    def __len__(self):
+        return len(self.options)
+
+    def add(self, option):
+        """Move the option's dense M and U into the next free slices of the stack."""
+        assert isinstance(option.m_model, DenseModel) and option.m_model.in_place and option.u_model.in_place, \
+            'Only dense, in place option models can be stacked.'
+        assert option.m_model.matrix.dtype == self.dtype, 'The option models must have the dtype of the stack.'
+        if len(self.options) == len(self.m_t):
+            self.grow(2 * len(self.m_t))
+        i = len(self.options)
+        self.m_t[i] = option.m_model.matrix.T
+        self.u_t[i] = option.u_model.matrix.T
+        self.options.append(option)
+        self.point(i)
+        return i
+
+    def grow(self, capacity):
+        """Reallocate the stack with the given capacity and re-point every option's models at it."""
+        m_t = np.zeros((capacity, self.n, self.n), dtype=self.dtype)
+        u_t = np.zeros((capacity, self.n, self.n), dtype=self.dtype)
+        m_t[:len(self.options)] = self.m_t[:len(self.options)]
+        u_t[:len(self.options)] = self.u_t[:len(self.options)]
+        self.m_t = m_t
+        self.u_t = u_t
+        for i in range(len(self.options)):
+            self.point(i)
+
+    def move_to(self, m_t, u_t):
+        """Copy the stack into the given (capacity, n, n) arrays, which may be slices of larger arrays, and re-point every
+        option's models at them. The capacity must be at least that of the stack."""
+        assert m_t.shape == u_t.shape and m_t.shape[0] >= len(self.m_t) and m_t.shape[1:] == (self.n, self.n), \
+            'The arrays must have the capacity and matrix shape of the stack.'
+        m_t[:len(self.m_t)] = self.m_t
+        u_t[:len(self.u_t)] = self.u_t
+        self.m_t = m_t
+        self.u_t = u_t
+        for i in range(len(self.options)):
+            self.point(i)
+
+    def load(self, m_t, u_t):
+        """Replace the stacked matrices of the options by the given (len(self), n, n) arrays, which may be
+        memory-mapped, and re-point every option's models at them."""
+        assert m_t.shape == u_t.shape == (len(self.options), self.n, self.n), 'The arrays must hold one slice per option.'
+        self.m_t = m_t
+        self.u_t = u_t
+        for i in range(len(self.options)):
+            self.point(i)
+
+    def point(self, i):
+        self.options[i].m_model.matrix = self.m_t[i].T
+        self.options[i].u_model.matrix = self.u_t[i].T
@@ -1,10 +1,16 @@
 """Manages data structures and methods necessary to learn and execute options in MDPs.
 An option consists of a policy, a universal option model (UOM), and a termination function."""
 
+# System
+import os
+
 # Third party
 import numpy as np
+import scipy.sparse
 
 # First party
+from imrl.utils.linear_algebra import dense, inner, norm, add_scaled, OneHotVector
+from imrl.agent.option.model import create_model, DenseModel
 
 
 class Subgoal(object):
@@ -28,28 +34,67 @@ class Subgoal(object):
 
 class Option:
 
-    def __init__(self, id, fa, policy, eta, gamma, subgoal, num_actions):
+    def __init__(self, id, fa, policy, eta, gamma, subgoal, num_actions, in_place=True, storage='dense', rank=20, directory=None):
         self.id = id
         self.fa = fa
         self.policy = policy
         self.num_actions = num_actions
-        self.m = np.zeros((fa.num_features, fa.num_features))
-        self.u = np.eye(fa.num_features, fa.num_features)
+        # M and U are kept in the given storage backend (see imrl.agent.option.model). Dense matrices are column-major,
+        # so that the column reads and writes made for sparse and one-hot feature vectors are contiguous. Updates are
+        # accumulated into them in place using the preallocated scratch vectors, unless in_place is unset, in which case
+        # every update leaves the previous matrix untouched and returns a new one. All arrays take the dtype of the fa.
+        # memmap storage keeps M and U in the files m<id>.npy and u<id>.npy in directory.
+        filenames = [os.path.join(directory, '{}{}.npy'.format(name, id)) if storage == 'memmap' else None for name in 'mu']
+        self.m_model = create_model(storage, fa.num_features, False, in_place, rank, fa.dtype, filenames[0])
+        self.u_model = create_model(storage, fa.num_features, True, in_place, rank, fa.dtype, filenames[1])
+        self.delta = np.empty((fa.num_features, 1), dtype=fa.dtype)
+        self.successor = np.empty((fa.num_features, 1), dtype=fa.dtype)
         self.eta = eta
         self.gamma = gamma
+        # Counts the updates of U, to invalidate the reward projections computed from it
+        self.u_version = 0
+        self.projections = {}
+        # Total Frobenius norm of all updates of M and U, and, when the option was last planned, the total of the options
+        # its planning depends on and the number of samples in its init set (see Agent.planning_change)
+        self.update_total = 0.0
+        self.planned_total = 0.0
+        self.planned_rows = -1
+        # Rows of the samples touched since the option was last planned, which seed its prioritized sweeping
+        self.pending_rows = set()
         if subgoal:
             self.subgoal = subgoal
             self.subgoal_fv = fa.evaluate(subgoal.state)
             # self.subgoal_fv_tolerance = np.linalg.norm(np.asarray(self.subgoal_fv - fa.evaluate(subgoal.state - subgoal.radius)), 2)
 
+    @property
+    def m(self):
+        """The option's transition model M in the native format of its storage backend."""
+        return self.m_model.matrix
+
+    @property
+    def u(self):
+        """The option's successor model U in the native format of its storage backend."""
+        return self.u_model.matrix
+
     def get_next_fv(self, fv):
         """Get expected next feature vector given feature vector fv."""
-        return np.dot(self.m, fv)
+        return self.m_model.dot(fv)
 
-    def get_return(self, r, fv):
+    def get_return(self, r, fv, r_version=None):
         """Calculate the expected return for executing the option in the state corresponding to the feature vector fv
-        given the reward function r."""
-        return np.dot(r.T, np.dot(self.u, fv))
+        given the reward function r. If the version of r is given, this is the O(n) product with its cached projection."""
+        if r_version is None:
+            return np.dot(r.T, self.u_model.dot(fv))
+        return inner(self.projection(r, r_version), fv)
+
+    def projection(self, r, r_version):
+        """Return the projected reward vector w = U^T r, so that the return at any fv is w^T fv. w is cached per reward
+        function and recomputed only once U or the given version of r has changed."""
+        entry = self.projections.get(id(r))
+        if entry is None or entry[0] is not r or entry[1] != (self.u_version, r_version):
+            entry = (r, (self.u_version, r_version), self.u_model.tdot(r))
+            self.projections[id(r)] = entry
+        return entry[2]
 
     def get_next_fv_from_state(self, s):
         """Get expected next feature vector given state s."""
@@ -68,16 +113,32 @@ class Option:
         return True  # self.id < self.num_actions or np.argmax(fv) <= self.subgoal.state  # TODO only works for combo lock
 
     def get_init_set(self):
-        return [s for s in self.policy.vi.agent.samples if self.can_init_from_state(s)]
+        samples = self.policy.vi.agent.samples
+        return [s for s, fv in zip(samples, self.fa.evaluate_each(samples)) if self.can_init_from_fv(fv)]
+
+    def get_init_rows(self):
+        """Return the rows of the agent's sample feature matrix of the samples from which the option can initialize, in
+        the order of the samples."""
+        agent = self.policy.vi.agent
+        fvs = agent.sample_features.fvs
+        return [row for row in agent.sample_rows if self.can_init_from_fv(fvs[row])]
 
     def is_terminal(self, fv):
         """Returns true if the option terminates in the given feature vector."""
         if self.id < self.num_actions:
             return True
-        if np.linalg.norm((fv - self.subgoal_fv), 2) <= 0.1:
+        if isinstance(fv, OneHotVector) and isinstance(self.subgoal_fv, OneHotVector):
+            return fv.index == self.subgoal_fv.index
+        if norm(dense(fv) - dense(self.subgoal_fv)) <= 0.1:
             return True
         return False
 
+    def is_terminal_batch(self, x):
+        """Return the boolean array of whether the option terminates in each row of the (B, n) array x."""
+        if self.id < self.num_actions:
+            return np.ones(len(x), dtype=bool)
+        return np.linalg.norm(x - dense(self.subgoal_fv)[:, 0], 2, axis=1) <= 0.1
+
     def is_terminal_in_state(self, state):
         """Returns true if the option terminates in the given state."""
         if self.id < self.num_actions:
@@ -88,19 +149,77 @@ class Option:
             return True
         return False
 
+    def relaxes(self, fv):
+        """Return whether an update at the one-hot fv can move the column of the in place dense models at its index
+        straight toward its target, without forming the difference."""
+        return isinstance(fv, OneHotVector) and isinstance(self.m_model, DenseModel) and self.m_model.in_place
+
     def update_m(self, fv, fv_prime, tau):
-        """Update M based on the previous feature vector fv and the next feature vector fv_prime."""
+        """Update M based on the previous feature vector fv and the next feature vector fv_prime and return it (see
+        imrl.agent.option.model for the return value of non-dense storage). Only the columns of M at the nonzero entries
+        of a sparse fv are touched."""
         assert fv.shape == fv_prime.shape, 'The feature vectors must be the same shape.'
-        m_prime = self.m + self.eta * np.dot((self.gamma ** tau) * fv_prime - np.dot(self.m, fv), fv.T)
-        assert m_prime.shape == self.m.shape, 'The updated M\' must have the same shape as the previous M.'
-        self.m = m_prime
-        return m_prime
+        if self.relaxes(fv):
+            self.update_total += self.eta * self.m_model.relax_column(fv.index, fv_prime, self.gamma ** tau, self.eta)
+            return self.m_model.matrix
+        delta = self.m_model.dot(fv, out=self.delta)
+        delta *= -1
+        add_scaled(delta, fv_prime, self.gamma ** tau)
+        self.update_total += self.eta * norm(delta) * norm(fv)
+        return self.m_model.add_outer(delta, fv, self.eta)
 
     def update_u(self, fv, fv_prime, terminal):
-        """Given the current matrix U and the previous feature vector fv, return the updated matrix U."""
-        successor_val = np.zeros((self.fa.num_features, 1)) if terminal else np.dot(self.u, fv_prime)
-        delta = fv + self.gamma * successor_val - np.dot(self.u, fv)
-        u_prime = self.u + self.eta * np.dot(delta, fv.T)
-        assert u_prime.shape == self.u.shape, 'The updated U\' must have the same shape as the previous U.'
-        self.u = u_prime
-        return u_prime
+        """Given the current matrix U and the previous feature vector fv, update U and return it."""
+        if terminal and self.relaxes(fv):
+            self.u_version += 1
+            self.update_total += self.eta * self.u_model.relax_column(fv.index, fv, 1.0, self.eta)
+            return self.u_model.matrix
+        delta = self.u_model.dot(fv, out=self.delta)
+        delta *= -1
+        if not terminal:
+            successor_val = self.u_model.dot(fv_prime, out=self.successor)
+            successor_val *= self.gamma
+            delta += successor_val
+        add_scaled(delta, fv, 1.0)
+        self.u_version += 1
+        self.update_total += self.eta * norm(delta) * norm(fv)
+        return self.u_model.add_outer(delta, fv, self.eta)
+
+    def update_m_batch(self, fm, fm_prime, tau, per_feature=False):
+        """Update M from a mini-batch of transitions, the rows of the (B, n) feature matrices fm and fm_prime (see
+        imrl.agent.option.model), of duration tau, a number or an array with one duration per transition. Every
+        transition's update is computed from the current M and the step size eta is applied to their mean, so a batch of
+        one matches update_m. With per_feature set, eta is instead applied to each update, and each column of their sum is
+        divided by the batch's total feature magnitude in it, if above 1 (see batch_step)."""
+        assert fm.shape == fm_prime.shape, 'The feature matrices must be the same shape.'
+        discounts = np.reshape(self.gamma ** np.asarray(tau, dtype=float), (-1, 1))
+        delta = discounts * fm_prime.toarray() - self.m_model.dot_batch(fm)
+        fm_step, scale = self.batch_step(fm, per_feature)
+        self.update_total += self.batch_update_norm(delta, fm_step, scale)
+        return self.m_model.add_outer_batch(delta, fm_step, scale)
+
+    def update_u_batch(self, fm, fm_prime, terminal, per_feature=False):
+        """Update U from a mini-batch of transitions, the rows of the (B, n) feature matrices fm and fm_prime, given the
+        boolean array of whether each transition terminates the option. The step size is applied as in update_m_batch."""
+        delta = fm.toarray() - self.u_model.dot_batch(fm)
+        if not np.all(terminal):
+            continuing = np.flatnonzero(~np.asarray(terminal))
+            delta[continuing] += self.gamma * self.u_model.dot_batch(fm_prime[continuing])
+        self.u_version += 1
+        fm_step, scale = self.batch_step(fm, per_feature)
+        self.update_total += self.batch_update_norm(delta, fm_step, scale)
+        return self.u_model.add_outer_batch(delta, fm_step, scale)
+
+    def batch_step(self, fm, per_feature):
+        """Return the feature matrix and scale with which the deltas of a mini-batch update are accumulated. Per feature,
+        the columns of fm are divided by their absolute sums above 1, so that transitions sharing features, such as
+        copies of a tabular state, take one step of eta between them rather than one each."""
+        if not per_feature:
+            return fm, self.eta / fm.shape[0]
+        magnitudes = np.asarray(abs(fm).sum(axis=0)).ravel()
+        return scipy.sparse.csr_matrix(fm.multiply(1.0 / np.maximum(magnitudes, 1.0))), self.eta
+
+    def batch_update_norm(self, delta, fm, scale):
+        """Return the sum of the Frobenius norms of the rank-1 updates that make up a mini-batch update."""
+        row_norms = np.sqrt(np.asarray(fm.multiply(fm).sum(axis=1)).ravel())
+        return scale * float(np.dot(np.linalg.norm(delta, axis=1), row_norms))
@@ -1,7 +1,12 @@
+# Third party
+import numpy as np
+
+
 class Policy:
 
     def __init__(self, num_actions):
         self.num_actions = num_actions
+        self.np_random = np.random
 
     def choose_action(self, state):
         raise NotImplementedError("Should choose an action given the state.")
@@ -1,8 +1,5 @@
 """Random policy implementation."""
 
-# Third party
-import numpy as np
-
 # First party
 from imrl.agent.policy.policy import Policy
 
@@ -16,7 +13,7 @@ class RandomPolicy(Policy):
         return self.choose_action_from_fv(state)
 
     def choose_action_from_fv(self, state):
-        return np.random.randint(self.num_actions)
+        return self.np_random.randint(self.num_actions)
 
 class RandomOptionPolicy(RandomPolicy):
 
@@ -29,4 +26,4 @@ class RandomOptionPolicy(RandomPolicy):
         return self.choose_action_from_fv(state)
 
     def choose_action_from_fv(self, stfvate):
-        return np.random.randint(len(self.agent.options) if self.use_options else self.num_actions)
+        return self.np_random.randint(len(self.agent.options) if self.use_options else self.num_actions)
@@ -1,17 +1,77 @@
 """Value function-based policy implementation."""
 
+# Third party
+import numpy as np
+
+# First party
 from imrl.agent.policy.policy import Policy
+from imrl.utils.linear_algebra import SparseVector, OneHotVector
+
+
+def feature_key(fv):
+    """Return a hashable key that is equal for equal feature vectors of the same kind."""
+    if isinstance(fv, OneHotVector):
+        return fv.index
+    if isinstance(fv, SparseVector):
+        return fv.indices.tobytes() + fv.values.tobytes()
+    return np.asarray(fv).tobytes()
 
 
 class VIPolicy(Policy):
+    """Greedy policy of a value iteration. update_table materializes the greedy options, with their ties, at every known
+    sample, and actions at those samples are then looked up by feature vector. Values are computed live at other states,
+    such as unseen continuous states, and everywhere once the value iteration has run again or samples have been added.
+    Between plans the table does not follow the small updates of the models and rewards that the values are computed
+    from."""
 
     def __init__(self, num_actions, vi):
         super(VIPolicy, self).__init__(num_actions)
         self.vi = vi
+        self.table = {}
+        self.table_key = None
 
     def choose_action(self, state):
         fv = self.vi.agent.fa.evaluate(state)
         return self.choose_action_from_fv(fv)
 
     def choose_action_from_fv(self, fv):
+        if self.table_key == self.key():
+            ties = self.table.get(feature_key(fv))
+            if ties is not None:
+                return self.vi.random.choice(ties)
         return self.vi.get_max_action(fv)
+
+    def key(self):
+        """Return the run count of the value iteration and the number of samples, which identify the table."""
+        return self.vi.version, len(self.vi.agent.samples)
+
+    def greedy(self, fm):
+        """Return the option ids and the (N, len(ids)) boolean array of the greedy options at each row of the feature
+        matrix fm, computed in one batch. As in ValueIteration.get_max_action, ties between primitive actions and options
+        are resolved towards the primitives."""
+        ids = np.asarray(self.vi.option_ids())
+        values = self.vi.get_values_batch(self.vi.theta, fm)
+        maximal = values == np.max(values, axis=1)[:, np.newaxis]
+        primitive = ids < self.vi.agent.num_actions
+        maximal &= primitive | ~np.any(maximal & primitive, axis=1)[:, np.newaxis]
+        return ids, maximal
+
+    def choose_actions_from_fm(self, fm):
+        """Return the array of the greedy options at each row of the feature matrix fm, breaking ties at random."""
+        ids, maximal = self.greedy(fm)
+        actions = ids[np.argmax(maximal, axis=1)]
+        for i in np.flatnonzero(maximal.sum(axis=1) > 1):
+            actions[i] = self.vi.random.choice(ids[maximal[i]].tolist())
+        return actions
+
+    def update_table(self):
+        """Compute the greedy options at all of the agent's samples from the current value function, in one batch."""
+        agent = self.vi.agent
+        fvs = agent.sample_features.fvs
+        self.table = {}
+        self.table_key = self.key()
+        if not fvs:
+            return
+        ids, maximal = self.greedy(agent.sample_features.matrix)
+        for fv, row in zip(fvs, maximal):
+            self.table[feature_key(fv)] = tuple(ids[row].tolist())
@@ -0,0 +1,69 @@
+"""Replay buffer of transitions for learning option models from mini-batches."""
+
+# Third party
+import numpy as np
+import scipy.sparse
+
+# First party
+from imrl.utils.linear_algebra import sparse_entries
+
+
+class ReplayBuffer(object):
+    """Ring buffer of the last capacity transitions (option, fv, fv_prime, terminal) in preallocated arrays.
+    Feature vectors are stored compactly as rows of the indices and values of their nonzero entries, width entries per
+    row. The width grows to that of the widest feature vector added; shorter rows are padded with zero values."""
+
+    def __init__(self, capacity, num_features, dtype=np.float64, width=1):
+        self.capacity = capacity
+        self.num_features = num_features
+        self.dtype = np.dtype(dtype)
+        self.options = np.zeros(capacity, dtype=int)
+        self.terminal = np.zeros(capacity, dtype=bool)
+        self.indices = np.zeros((2, capacity, width), dtype=int)
+        self.values = np.zeros((2, capacity, width), dtype=self.dtype)
+        self.size = 0
+        self.position = 0
+        self.np_random = np.random
+
+    def __len__(self):
+        return self.size
+
+    def add(self, option, fv, fv_prime, terminal):
+        """Store a transition, overwriting the oldest one once the buffer is full."""
+        i = self.position
+        self.options[i] = option
+        self.terminal[i] = terminal
+        for slot, f in enumerate([fv, fv_prime]):
+            indices, values = sparse_entries(f)
+            if len(indices) > self.indices.shape[2]:
+                self.widen(len(indices))
+            self.indices[slot, i] = 0
+            self.values[slot, i] = 0.0
+            self.indices[slot, i, :len(indices)] = indices
+            self.values[slot, i, :len(indices)] = values
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def widen(self, width):
+        """Reallocate the feature arrays with room for width nonzero entries per feature vector."""
+        indices = np.zeros((2, self.capacity, width), dtype=int)
+        values = np.zeros((2, self.capacity, width), dtype=self.dtype)
+        indices[:, :, :self.indices.shape[2]] = self.indices
+        values[:, :, :self.values.shape[2]] = self.values
+        self.indices = indices
+        self.values = values
+
+    def sample(self, batch_size):
+        """Return the positions of a uniformly random mini-batch of at most batch_size distinct stored transitions."""
+        return self.np_random.choice(self.size, min(batch_size, self.size), replace=False)
+
+    def features(self, rows, next_state=False):
+        """Return the feature vectors (or, if next_state is set, the next feature vectors) of the transitions at the
+        given positions as the rows of a (len(rows), num_features) csr matrix."""
+        slot = 1 if next_state else 0
+        width = self.indices.shape[2]
+        fm = scipy.sparse.csr_matrix((self.values[slot, rows].ravel(), self.indices[slot, rows].ravel(),
+                                      np.arange(len(rows) + 1) * width), shape=(len(rows), self.num_features))
+        fm.sum_duplicates()
+        fm.eliminate_zeros()
+        return fm
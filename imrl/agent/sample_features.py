@@ -0,0 +1,79 @@
+"""Feature vectors of the agent's state samples."""
+
+# Third party
+import numpy as np
+import scipy.sparse
+
+# First party
+from imrl.utils.linear_algebra import sparse_entries
+
+
+class SampleFeatures(object):
+    """Feature vectors of the state samples in the order they were added, kept as a list and as the rows of the (N, n)
+    csr feature matrix Phi. The nonzero entries are appended to arrays that double in size when full, so adding a
+    sample costs O(nnz) and Phi is rebuilt over the arrays without copying them. The csc form of Phi indexes the rows
+    with a nonzero entry at each feature, and is rebuilt the first time it is needed after samples were added."""
+
+    def __init__(self, num_features, dtype=np.float64, capacity=64):
+        self.num_features = num_features
+        self.fvs = []
+        self.indices = np.zeros(capacity, dtype=int)
+        self.values = np.zeros(capacity, dtype=dtype)
+        self.indptr = np.zeros(capacity + 1, dtype=int)
+        self.phi = None
+        self.columns = None
+
+    def __len__(self):
+        return len(self.fvs)
+
+    def append(self, fv):
+        """Add the feature vector of a new sample as the last row of Phi and return its row index."""
+        indices, values = sparse_entries(fv)
+        row = len(self.fvs)
+        start = self.indptr[row]
+        end = start + len(indices)
+        if end > len(self.indices):
+            capacity = max(2 * len(self.indices), end)
+            self.indices = np.concatenate([self.indices, np.zeros(capacity - len(self.indices), dtype=int)])
+            self.values = np.concatenate([self.values, np.zeros(capacity - len(self.values), dtype=self.values.dtype)])
+        if row + 1 == len(self.indptr):
+            self.indptr = np.concatenate([self.indptr, np.zeros(len(self.indptr) - 1, dtype=int)])
+        self.indices[start:end] = indices
+        self.values[start:end] = values
+        self.indptr[row + 1] = end
+        self.fvs.append(fv)
+        self.phi = None
+        self.columns = None
+        return row
+
+    @property
+    def matrix(self):
+        """The (N, n) csr feature matrix Phi, one row per sample."""
+        if self.phi is None:
+            n = len(self.fvs)
+            nnz = self.indptr[n]
+            self.phi = scipy.sparse.csr_matrix((self.values[:nnz], self.indices[:nnz], self.indptr[:n + 1]),
+                                               shape=(n, self.num_features))
+        return self.phi
+
+    def column_products(self, features, x):
+        """Return the sorted array of the rows of Phi with a nonzero entry at any of the given features, and the (R, k)
+        array of the products of those rows, restricted to the given features, with the (len(features), k) array x of the
+        entries at those features. Only the entries of Phi in the columns of the given features are read."""
+        if self.columns is None:
+            self.columns = self.matrix.tocsc()
+        features = np.asarray(features, dtype=int)
+        starts = self.columns.indptr[features]
+        lengths = self.columns.indptr[features + 1] - starts
+        total = np.sum(lengths)
+        if 2 * total > self.columns.nnz:
+            # Most of Phi is read anyway, and one sparse product with all of it is cheaper than gathering the columns
+            full = np.zeros((self.num_features, x.shape[1]), dtype=x.dtype)
+            full[features] = x
+            return np.arange(len(self.fvs)), np.asarray(self.matrix.dot(full))
+        # The positions in the csc arrays of the entries of every given column, one column after the other
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+        rows, inverse = np.unique(self.columns.indices[positions], return_inverse=True)
+        entries = self.columns.data[positions][:, np.newaxis] * np.repeat(x, lengths, axis=0)
+        products = np.column_stack([np.bincount(inverse, entries[:, j], len(rows)) for j in range(x.shape[1])])
+        return rows, products.reshape(len(rows), x.shape[1])
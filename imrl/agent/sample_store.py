@@ -0,0 +1,85 @@
+"""Index of the agent's state samples."""
+
+# System
+import bisect
+import itertools
+from collections.abc import Sequence
+
+# Third party
+import numpy as np
+
+
+class SampleStore(Sequence):
+    """The agent's state samples with the row of each in the sample feature matrix, indexed for finding the sample that
+    stands for a state. The kind of index is chosen by the first sample added:
+    - Discrete (int) samples are kept sorted, with a dict from each sample to its row, so a lookup costs O(1) and an
+      insertion a bisection plus a list insert.
+    - Continuous samples are kept in the order they were added and hashed into a grid of cells of width epsilon. The
+      samples within epsilon of a state lie in the 3^d cells around the state's cell, so a lookup only measures the
+      distance to those. Like a linear scan, it returns the first added sample within epsilon."""
+
+    def __init__(self, epsilon):
+        self.epsilon = epsilon
+        self.discrete = None
+        self.states = []
+        self.rows = []
+        self.row_of = {}
+        self.cells = {}
+        self.neighbours = None
+
+    def __len__(self):
+        return len(self.states)
+
+    def __getitem__(self, i):
+        return self.states[i]
+
+    def __iter__(self):
+        return iter(self.states)
+
+    def __contains__(self, state):
+        return self.find(state) is not None
+
+    def index(self, state, start=0, stop=None):
+        """Return the position of a discrete sample in the sample order."""
+        if self.discrete:
+            i = bisect.bisect_left(self.states, state, start, len(self.states) if stop is None else stop)
+            if i < len(self.states) and self.states[i] == state:
+                return i
+            raise ValueError('{} is not a sample'.format(state))
+        return super(SampleStore, self).index(state, start, len(self.states) if stop is None else stop)
+
+    def cell(self, state):
+        if self.epsilon <= 0:
+            return np.asarray(state, dtype=float).tobytes()
+        return tuple(np.floor(np.asarray(state, dtype=float) / self.epsilon).astype(int).tolist())
+
+    def find(self, state):
+        """Return the row of the sample that stands for the given state, or None if there is none."""
+        if self.discrete is None:
+            return None
+        if self.discrete:
+            return self.row_of.get(state)
+        cell = self.cell(state)
+        if self.epsilon <= 0:
+            candidates = self.cells.get(cell, [])
+        else:
+            candidates = [i for offset in self.neighbours for i in self.cells.get(tuple(c + o for c, o in zip(cell, offset)), [])]
+        for i in sorted(candidates):
+            if np.linalg.norm(np.asarray(self.states[i] - state), 2) <= self.epsilon:
+                return self.rows[i]
+        return None
+
+    def add(self, state, row):
+        """Add a state with no sample standing for it as a new sample, whose feature vector is at the given row."""
+        if self.discrete is None:
+            self.discrete = isinstance(state, int)
+            self.neighbours = None if self.discrete else list(itertools.product((-1, 0, 1), repeat=np.size(state)))
+        if self.discrete:
+            i = bisect.bisect_left(self.states, state)
+            self.states.insert(i, state)
+            self.rows.insert(i, row)
+            self.row_of[state] = row
+        else:
+            self.cells.setdefault(self.cell(state), []).append(len(self.states))
+            self.states.append(state)
+            self.rows.append(row)
@@ -0,0 +1,77 @@
+"""Index of the candidate subgoals of an environment."""
+
+# System
+import itertools
+from collections.abc import Sequence
+
+# Third party
+import numpy as np
+
+
+class SubgoalRegistry(Sequence):
+    """The candidate subgoals in the order given, indexed for finding the first unreached subgoal that a state reaches,
+    with the reached status of each subgoal kept in a boolean array.
+    - Discrete (int) subgoals are reached by their state, which is hashed.
+    - Continuous subgoals are reached within their radius of their center. The centers are hashed into a grid of cells
+      as wide as the largest radius, so a state can only reach the subgoals in the 3^d cells around its cell.
+    Reaching a subgoal marks every subgoal equal to it as reached."""
+
+    def __init__(self, subgoals):
+        self.subgoals = list(subgoals)
+        self.reached = np.zeros(len(self.subgoals), dtype=bool)
+        self.reached_order = []
+        self.discrete = bool(self.subgoals) and isinstance(self.subgoals[0].state, int)
+        self.width = 0 if self.discrete or not self.subgoals else max(g.radius for g in self.subgoals)
+        self.neighbours = [()] if not self.subgoals or self.discrete or self.width <= 0 else \
+            list(itertools.product((-1, 0, 1), repeat=np.size(self.subgoals[0].state)))
+        # Subgoals by cell, and by identity key so that equal subgoals are reached together
+        self.cells = {}
+        self.equal = {}
+        for i, g in enumerate(self.subgoals):
+            self.cells.setdefault(self.cell(g.state), []).append(i)
+            self.equal.setdefault(self.key(g), []).append(i)
+
+    def __len__(self):
+        return len(self.subgoals)
+
+    def __getitem__(self, i):
+        return self.subgoals[i]
+
+    def __contains__(self, g):
+        return self.key(g) in self.equal
+
+    def key(self, g):
+        return g.state if isinstance(g.state, int) else (np.asarray(g.state, dtype=float).tobytes(), g.radius)
+
+    def cell(self, state):
+        if self.discrete:
+            return state
+        if self.width <= 0:
+            return np.asarray(state, dtype=float).tobytes()
+        return tuple(np.floor(np.asarray(state, dtype=float) / self.width).astype(int).tolist())
+
+    def reached_subgoals(self):
+        """Return the reached subgoals in the order they were reached."""
+        return [self.subgoals[i] for i in self.reached_order]
+
+    def reach(self, state):
+        """Mark the first unreached subgoal that the state reaches, and those equal to it, as reached and return it, or
+        return None if the state reaches no unreached subgoal."""
+        cell = self.cell(state)
+        if self.discrete or self.width <= 0:
+            candidates = self.cells.get(cell, [])
+        else:
+            candidates = sorted(i for offset in self.neighbours
+                                for i in self.cells.get(tuple(c + o for c, o in zip(cell, offset)), []))
+        for i in candidates:
+            g = self.subgoals[i]
+            if not self.reached[i] and (self.discrete or np.linalg.norm(np.asarray(g.state - state), 2) <= g.radius):
+                return self.mark_reached(i)
+        return None
+
+    def mark_reached(self, i):
+        """Mark the i-th subgoal, and those equal to it, as reached and return it."""
+        g = self.subgoals[i]
+        self.reached[self.equal[self.key(g)]] = True
+        self.reached_order.append(i)
+        return g
@@ -1,66 +1,284 @@
 """Value iteration algorithm."""
 
 # System
+import heapq
+import logging
 import random
 
 # Third party
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+# First party
+from imrl.utils.linear_algebra import dense, inner, add_scaled, batch_matvec, batch_tmatvec, sparse_entries
 
 
 class ValueIteration:
+    """Approximate value iteration over the agent's state samples. Each sweep backs up the samples either one at a time,
+    every backup seeing the updates of the ones before it (gauss_seidel ordering), or all at once from the same theta
+    as a few products with the samples' feature matrix (jacobi ordering).
+    Every sweep records the residual, the max or l2 norm of the Bellman errors of its samples, and if a tolerance is
+    given a run stops as soon as the residual falls below it, with iterations as the cap on the number of sweeps.
+    The prioritized ordering replaces sweeps by prioritized sweeping (see run_prioritized), and for tabular features the
+    policy_iteration ordering solves for the fixed point of the sweeps exactly (see run_policy_iteration)."""
 
-    def __init__(self, id, reward_functions, agent, iterations, retain_theta=True, use_options=False, alpha=0.1, gamma=0.99):
+    def __init__(self, id, reward_functions, agent, iterations, retain_theta=True, use_options=False, alpha=0.1, gamma=0.99,
+                 ordering='gauss_seidel', tolerance=None, residual_norm='max', budget=None):
+        assert ordering in ('gauss_seidel', 'jacobi', 'prioritized', 'policy_iteration'), \
+            'Unknown value iteration ordering {}'.format(ordering)
+        assert residual_norm in ('max', 'l2'), 'Unknown residual norm {}'.format(residual_norm)
         self.id = id
         self.agent = agent
         self.r = reward_functions
         self.iterations = iterations
         self.alpha = alpha
         self.gamma = gamma
-        self.theta = np.zeros((agent.fa.num_features, 1))
+        self.theta = np.zeros((agent.fa.num_features, 1), dtype=agent.fa.dtype)
         self.use_options = use_options
         self.retain_theta = retain_theta
+        self.ordering = ordering
+        self.tolerance = tolerance
+        self.residual_norm = residual_norm
+        self.residuals = []
+        # Prioritized sweeping state: a max-heap of (-priority, row) entries, of which only the ones matching priorities
+        # are current, the rows eligible in the last run, and the number of backups allowed per run, by default as many
+        # as the sweeps would make
+        self.budget = budget
+        self.queue = []
+        self.priorities = {}
+        self.eligible = np.zeros(0, dtype=bool)
+        # Breaks ties between greedy options
+        self.random = random
+        # Number of runs so far, which identifies the value function that greedy policies were computed from
+        self.version = 0
+        self.projection_key = None
+        self.projection_matrix = None
 
-    def run(self):
-        """Run value iteration for the given number of iterations starting from a zero-initialized value function"""
-        theta = self.theta if self.retain_theta else np.zeros((self.agent.fa.num_features, 1))
+    def run(self, seeds=None):
+        """Run value iteration for the given number of iterations, or until the residual falls below the tolerance,
+        starting from a zero-initialized value function unless theta is retained. The residuals of the run's sweeps are
+        left in residuals. Only prioritized sweeping uses the seeds, the sample rows whose values may have changed."""
+        theta = self.theta if self.retain_theta else np.zeros((self.agent.fa.num_features, 1), dtype=self.agent.fa.dtype)
+        self.residuals = []
+        self.version += 1
+        if self.ordering == 'prioritized':
+            self.theta = self.run_prioritized(theta, seeds if self.retain_theta else None)
+            return self.theta
+        if self.ordering == 'policy_iteration':
+            self.theta = self.run_policy_iteration(theta)
+            return self.theta
         for i in range(self.iterations):
             theta = self.sweep(theta)
+            if self.tolerance is not None and self.residuals[-1] <= self.tolerance:
+                break
         self.theta = theta
+        logging.debug('Value iteration {} ran {} sweeps with residuals {}'.format(self.id, len(self.residuals), self.residuals))
         return theta
 
-    def sweep(self, theta):
-        """Adjust the current value function estimate theta by performing a full backup."""
-        if self.use_options:
-            option_set = [o for i, o in self.agent.options.items() if i != self.id]
-        else:
-            option_set = [o for i, o in self.agent.options.items() if i < self.agent.num_actions]
+    def sample_rows(self):
+        """Return the rows of the agent's sample feature matrix that are backed up, in the order of the samples."""
         if self.id >= self.agent.num_actions:
-            samples = self.agent.options[self.id].get_init_set()
+            return self.agent.options[self.id].get_init_rows()
+        return self.agent.sample_rows
+
+    def sweep(self, theta):
+        """Adjust the current value function estimate theta by performing a full backup and record its residual."""
+        rows = self.sample_rows()
+        if self.ordering == 'jacobi' and rows:
+            phi = self.agent.sample_features.matrix
+            phi = phi if len(rows) == phi.shape[0] else phi[rows]
+            # Every row is backed up from the same theta. Summing their backups would overshoot wherever the rows share
+            # features, so each feature's update is divided by sum_i |phi_if| * |phi_i|_1, which bounds the gain of the
+            # summed update by 1 (Gershgorin). Distinct one-hot rows keep the plain sum of their backups.
+            errors = self.bellman_errors(theta, phi)
+            magnitudes = abs(phi)
+            scale = np.asarray(magnitudes.T.dot(magnitudes.sum(axis=1))).ravel()
+            scale[scale == 0] = 1.0
+            theta += self.alpha * (phi.T.dot(errors) / scale)[:, np.newaxis]
         else:
-            samples = self.agent.samples
-        for s in samples:
-            theta = self.backup(theta, s, option_set)
+            fvs = self.agent.sample_features.fvs
+            errors = np.zeros(len(rows))
+            for j, row in enumerate(rows):
+                errors[j] = self.bellman_error(theta, fvs[row])
+                add_scaled(theta, fvs[row], self.alpha * errors[j])
+        self.residuals.append(self.residual(errors))
         return theta
 
-    def backup(self, theta, s, options):
-        """Get the maximum Bellman residual over all options."""
-        fv = self.agent.fa.evaluate(s)
-        max_value = max([self.get_value(theta, o, fv) for o in options])
-        delta = (self.alpha * (max_value - np.dot(fv.T, theta))) * fv
-        return theta + delta
+    def run_prioritized(self, theta, seeds=None):
+        """Prioritized sweeping. The seed rows, or all rows if seeds is None, are queued with the magnitude of their
+        Bellman error as priority, together with the rows that were not eligible in the previous run, which have never
+        been backed up: all of them in the first run. The row of highest priority is backed up, and the change of theta
+        raises the priority of its predecessors, the rows whose values depend on theta where the backed up row has
+        features, by a bound on the change of their Bellman errors (see predecessor_weights). This repeats until the
+        budget of backups is spent or the highest priority falls below the tolerance. Rows still queued carry over to
+        the next run. The residuals are the Bellman errors of the backups made, in order."""
+        rows = self.sample_rows()
+        eligible = np.zeros(len(self.agent.sample_features), dtype=bool)
+        eligible[rows] = True
+        if seeds is not None:
+            previous = self.eligible
+            seeds = set(seeds)
+            seeds = [row for row in seeds if eligible[row]] + \
+                [row for row in rows if (row >= len(previous) or not previous[row]) and row not in seeds]
+        self.eligible = eligible
+        for row in (rows if seeds is None else seeds):
+            self.prioritize(row, abs(self.bellman_error(theta, self.agent.sample_features.fvs[row])))
+        budget = self.budget if self.budget is not None else self.iterations * len(rows)
+        threshold = self.tolerance or 0.0
+        while self.queue and len(self.residuals) < budget:
+            priority, row = heapq.heappop(self.queue)
+            if self.priorities.get(row) != -priority:
+                continue  # Superseded by a later entry of the row
+            del self.priorities[row]
+            if -priority <= threshold:
+                break
+            fv = self.agent.sample_features.fvs[row]
+            error = self.bellman_error(theta, fv)
+            add_scaled(theta, fv, self.alpha * error)
+            self.residuals.append(abs(error))
+            predecessors, weights = self.predecessor_weights(theta, fv)
+            weights *= self.alpha * abs(error)
+            raised = (weights > threshold) & eligible[predecessors] & (predecessors != row)
+            for i, weight in zip(predecessors[raised].tolist(), weights[raised].tolist()):
+                self.prioritize(i, self.priorities.get(i, 0.0) + weight)
+        return theta
+
+    def run_policy_iteration(self, theta):
+        """Policy iteration for tabular features, where every sample row of phi is one-hot and theta holds the value of
+        each state. The fixed point of the backups satisfies v = w_pi + gamma M_pi^T theta at the sampled states, where
+        w_pi and M_pi select the reward projection and the column of M of the option chosen in each state, and theta is
+        kept fixed at the other states. Each iteration evaluates the greedy policy by solving the sparse system
+        (I - gamma M_pi[S, S]^T) v = w_pi + gamma M_pi[rest, S]^T theta[rest] and stops once the greedy policy no longer
+        changes, for at most iterations iterations. The residuals are those of the values after each evaluation."""
+        rows = self.sample_rows()
+        if not rows:
+            return theta
+        phi = self.agent.sample_features.matrix[rows]
+        assert np.all(np.diff(phi.indptr) == 1) and np.all(phi.data == 1), 'Policy iteration requires tabular features.'
+        states = phi.indices
+        ids = self.option_ids()
+        returns = self.projections(ids)[states]
+        columns = [self.agent.options[i].m_model.columns_at(states) for i in ids]
+        boundary = np.ones(len(theta), dtype=bool)
+        boundary[states] = False
+        policy = np.argmax(self.get_values_batch(theta, phi), axis=1)
+        for i in range(self.iterations):
+            # Row j of transitions is the column of M of the option chosen in the j-th sampled state
+            chosen = [np.flatnonzero(policy == o) for o in range(len(ids))]
+            order = np.argsort(np.concatenate(chosen), kind='stable')
+            transitions = scipy.sparse.vstack([columns[o][j] for o, j in enumerate(chosen)], format='csr')[order]
+            b = returns[np.arange(len(states)), policy] + self.gamma * transitions[:, boundary].dot(theta[boundary, 0])
+            a = scipy.sparse.identity(len(states), format='csc') - self.gamma * transitions[:, states].tocsc()
+            theta[states, 0] = scipy.sparse.linalg.spsolve(a, b)
+            values = self.get_values_batch(theta, phi)
+            self.residuals.append(self.residual(np.max(values, axis=1) - theta[states, 0]))
+            # Only switch options in the states where another one is strictly better, so the iteration terminates
+            improvable = np.max(values, axis=1) > values[np.arange(len(states)), policy] + 1e-10
+            if not np.any(improvable):
+                break
+            policy[improvable] = np.argmax(values[improvable], axis=1)
+        return theta
+
+    def prioritize(self, row, priority):
+        """Queue the row with the given priority, superseding any earlier entry of it. The heap is rebuilt from the
+        current entries once superseded ones make up most of it."""
+        self.priorities[row] = priority
+        heapq.heappush(self.queue, (-priority, row))
+        if len(self.queue) > 4 * len(self.priorities) + 64:
+            self.queue = [(-p, i) for i, p in self.priorities.items()]
+            heapq.heapify(self.queue)
+
+    def predecessor_weights(self, theta, fv):
+        """Return the rows phi_i of the sample feature matrix whose Bellman errors depend on theta along fv and, for each,
+        a bound on the change of its Bellman error per unit change of theta along fv: |phi_i^T fv| for its own value plus
+        gamma * max over options of |phi_i^T M^T fv| for the backed up next state values. Only the rows with features in
+        the support of fv or of some M^T fv are touched, found through the columns of the sample feature matrix."""
+        ids = self.option_ids()
+        stack = self.agent.model_stack
+        if stack is None:
+            predecessors = np.hstack([self.agent.options[i].m_model.tdot(dense(fv)) for i in ids])
+        else:
+            predecessors = batch_tmatvec(stack.m_t[:ids[-1] + 1], fv)[ids].T
+        indices, _ = sparse_entries(fv)
+        support = np.union1d(indices, np.flatnonzero(np.any(predecessors != 0, axis=1)))
+        x = np.hstack([dense(fv)[support], predecessors[support]])
+        rows, products = self.agent.sample_features.column_products(support, x)
+        return rows, np.abs(products[:, 0]) + self.gamma * np.max(np.abs(products[:, 1:]), axis=1)
+
+    def residual(self, errors):
+        """Return the max or l2 norm, according to residual_norm, of an array of Bellman errors."""
+        if len(errors) == 0:
+            return 0.0
+        return float(np.max(np.abs(errors)) if self.residual_norm == 'max' else np.linalg.norm(errors))
+
+    def backup(self, theta, fv):
+        """Move theta in place towards the maximum backed up value over all options at fv."""
+        return add_scaled(theta, fv, self.alpha * self.bellman_error(theta, fv))
+
+    def bellman_error(self, theta, fv):
+        """Return the difference between the maximum backed up value over all options at fv and its value under theta."""
+        return np.max(self.get_values(theta, fv)) - inner(theta, fv).item()
+
+    def bellman_errors(self, theta, phi):
+        """Return the array of the Bellman errors at every row of the (N, n) feature matrix phi."""
+        return np.max(self.get_values_batch(theta, phi), axis=1) - phi.dot(theta)[:, 0]
+
+    def option_ids(self):
+        """Ids, in ascending order, of the options backed up over: every other option, or only the primitive actions."""
+        if self.use_options:
+            return [i for i in self.agent.options if i != self.id]
+        return list(range(self.agent.num_actions))
+
+    def reward(self, o):
+        """Return the reward function under which option o is evaluated."""
+        return self.r[0] if len(self.r) == 1 else self.r[o.id]
+
+    def projections(self, ids):
+        """Return the (n, len(ids)) matrix whose columns are the options' reward projections U^T r (see
+        Option.projection), so the returns of all of them at fv are the single product with fv. The matrix is
+        reassembled only when some option's U or reward function has changed."""
+        options = [self.agent.options[i] for i in ids]
+        rewards = [self.reward(o) for o in options]
+        key = [(o.id, o.u_version, id(r), self.agent.reward_version(r)) for o, r in zip(options, rewards)]
+        if key != self.projection_key:
+            self.projection_matrix = np.hstack([o.projection(r, self.agent.reward_version(r)) for o, r in zip(options, rewards)])
+            self.projection_key = key
+        return self.projection_matrix
+
+    def get_values(self, theta, fv):
+        """Return the array of the values at fv of the options in option_ids. Returns come from the cached reward
+        projections. With a model stack the expected next feature vectors of all options are one batched product with the
+        stacked M, otherwise they are computed option by option."""
+        ids = self.option_ids()
+        stack = self.agent.model_stack
+        if stack is None:
+            return np.asarray([self.get_value(theta, self.agent.options[i], fv).item() for i in ids])
+        returns = inner(self.projections(ids), fv)[:, 0]
+        next_values = np.dot(batch_matvec(stack.m_t[:ids[-1] + 1], fv), theta)[ids, 0]
+        return returns + self.gamma * next_values
+
+    def get_values_batch(self, theta, phi):
+        """Return the (N, len(option_ids)) array of the values of the options in option_ids at each row of the (N, n)
+        feature matrix phi. The next state values theta^T M phi are computed as phi (M^T theta), so each option model is
+        multiplied once, by theta, whatever the number of rows."""
+        ids = self.option_ids()
+        stack = self.agent.model_stack
+        if stack is None:
+            next_projections = np.hstack([self.agent.options[i].m_model.tdot(theta) for i in ids])
+        else:
+            next_projections = np.matmul(stack.m_t[:ids[-1] + 1], theta)[ids, :, 0].T
+        return phi.dot(self.projections(ids)) + self.gamma * phi.dot(next_projections)
 
     def get_value(self, theta, o, fv):
         """Calculate the scalar product that is used in both the theta and policy calculations."""
-        r = self.r[0] if len(self.r) == 1 else self.r[o.id]
-        return o.get_return(r, fv) + self.gamma * np.dot(o.get_next_fv(fv).T, theta)
+        r = self.reward(o)
+        return o.get_return(r, fv, self.agent.reward_version(r)) + self.gamma * np.dot(o.get_next_fv(fv).T, theta)
 
     def get_max_action(self, fv):
-        if self.use_options:
-            values = [self.get_value(self.theta, o, fv) for o in self.agent.options.values() if o.id != self.id]
-        else:
-            values = [self.get_value(self.theta, o, fv) for o in self.agent.options.values() if o.id < self.agent.num_actions]
-        max_value = max(values)
-        max_value_actions = [i for i, x in enumerate(values) if x == max_value]
+        ids = self.option_ids()
+        values = self.get_values(self.theta, fv)
+        max_value_actions = [ids[i] for i in np.flatnonzero(values == np.max(values))]
 
         # If max value actions include both options and primitives, only select from the primitives.
         primitives = [i for i in max_value_actions if i < self.agent.num_actions]
@@ -68,4 +286,4 @@ class ValueIteration:
             max_value_actions = primitives
         # else:
         #     print('Option chosen: ' + str(values))
-        return random.choice(max_value_actions)
+        return self.random.choice(max_value_actions)
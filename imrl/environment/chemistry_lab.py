@@ -39,7 +39,7 @@ class ChemistryLab(Environment):
 
     def initial_state(self):
         """The starting position is 0 at every dimension except the first, which starts at 0.5."""
-        position = [max(np.random.normal(0, self.move_sd), 0.0) for _ in range(self.num_actions)]
+        position = [max(self.np_random.normal(0, self.move_sd), 0.0) for _ in range(self.num_actions)]
         position[0] = 0.5
         return position
 
@@ -117,8 +117,8 @@ class ChemistryLab(Environment):
 
     def next_state(self, state, action):
         """Apply the given action and return the next state.  This should never be called if state is already terminal.  The action being altered is that action's integer value starting at 0."""
-        noise = np.random.normal(0, self.move_sd)
-        move = np.random.normal(self.move_mean, self.move_sd)
+        noise = self.np_random.normal(0, self.move_sd)
+        move = self.np_random.normal(self.move_mean, self.move_sd)
         potential_state = np.full((1, self.num_actions), noise)
         potential_state[:, action] = move
         potential_state = np.add(state, potential_state)
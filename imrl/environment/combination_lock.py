@@ -1,8 +1,5 @@
 """Combination lock environment."""
 
-# System
-import random
-
 # First party
 from imrl.agent.option.option import Subgoal
 from imrl.environment.gridworld import GridPosition, Gridworld
@@ -46,7 +43,7 @@ class CombinationLock(Gridworld):
     def next_state(self, state, action):
         """Apply the given action and return the next state.  This should never be called if state is already terminal."""
         potential_position = self.actions_from_state(state) + [action]
-        if random.random() > self.failure_rate:
+        if self.random.random() > self.failure_rate:
             if self.is_terminal(potential_position) or state == self.num_states() - 1:
                 return self.initial_state()
             else:
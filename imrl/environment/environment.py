@@ -1,10 +1,18 @@
 """Abstract class for environment."""
 
+# System
+import random
+
+# Third party
+import numpy as np
+
 
 class Environment(object):
 
     def __init__(self, num_actions):
         self.num_actions = num_actions
+        self.random = random
+        self.np_random = np.random
 
     def reward(self, state):
         raise NotImplementedError("Should return reward for transitioning into given state.")
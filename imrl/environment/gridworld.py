@@ -3,7 +3,6 @@
 # System
 from collections import namedtuple
 from enum import IntEnum
-import random
 # First party
 from imrl.utils.linear_algebra import one_hot_vector
 from imrl.environment.environment import Environment
@@ -68,7 +67,7 @@ class Gridworld(Environment):
         """Apply the given action and return the next state."""
         position = self.grid_position_from_state(state)
         next_state = position
-        if random.random() > self.failure_rate:
+        if self.random.random() > self.failure_rate:
             mapped_action = Action(action)
             tentative_state = (mapped_action == Action.up and GridPosition(position.x, position.y + 1)) or \
                               (mapped_action == Action.down and GridPosition(position.x, position.y - 1)) or \
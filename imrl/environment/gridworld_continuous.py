@@ -29,8 +29,8 @@ class GridworldContinuous(Environment):
 
     def initial_state(self):
         """The state in which the agent starts at the beginning of each episode."""
-        x_pos = max(np.random.normal(0, 0.01), 0)
-        y_pos = max(np.random.normal(0, 0.01), 0)
+        x_pos = max(self.np_random.normal(0, 0.01), 0)
+        y_pos = max(self.np_random.normal(0, 0.01), 0)
         return np.asarray([x_pos, y_pos])
 
     def is_terminal(self, state):
@@ -41,8 +41,8 @@ class GridworldContinuous(Environment):
     def next_state(self, state, action):
         """Apply the given action and return the new state."""
         mapped_action = Action(action)
-        noise = np.random.normal(0, self.move_sd)
-        move = np.random.normal(self.move_mean, self.move_sd)
+        noise = self.np_random.normal(0, self.move_sd)
+        move = self.np_random.normal(self.move_mean, self.move_sd)
         tentative_pos = (mapped_action == Action.up and GridPosition(state[0] + noise, state[1] + move)) or \
                         (mapped_action == Action.down and GridPosition(state[0] + noise, state[1] - move)) or \
                         (mapped_action == Action.left and GridPosition(state[0] - move, state[1] + noise)) or \
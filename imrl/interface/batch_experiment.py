@@ -0,0 +1,53 @@
+"""Experiments over many seeds run in lockstep."""
+
+# System
+import logging
+import random
+
+# Third party
+import numpy as np
+
+# First party
+from imrl.agent.batch_agent import BatchAgent
+
+
+class BatchExperiment(object):
+    """Runs the experiment of Experiment2 for K agents, each in its own environment with its own seed, in lockstep: at
+    every step the agents choose their actions together, each environment moves, and all of them are updated together
+    by a BatchAgent. Each agent plans at the end of its own intervals and stops at the end of the first interval that
+    reaches the number of steps, like Experiment2. Each agent and its environment draw from their own random.Random and
+    numpy.random.RandomState seeded with the agent's seed, so each agent learns what Experiment2 learns with the random
+    and numpy.random modules seeded with its seed."""
+
+    def __init__(self, agents, environments, steps, seeds):
+        assert len(agents) == len(environments) == len(seeds)
+        self.batch = BatchAgent(agents)
+        self.agents = agents
+        self.environments = environments
+        self.max_steps = steps
+        self.steps = [0] * len(agents)
+        self.intervals = [0] * len(agents)
+        self.seeds = seeds
+        for agent, environment, seed in zip(agents, environments, seeds):
+            random_generator, numpy_generator = random.Random(seed), np.random.RandomState(seed)
+            agent.use_generators(random_generator, numpy_generator)
+            environment.random, environment.np_random = random_generator, numpy_generator
+
+    def run(self):
+        states = [environment.initial_state() for environment in self.environments]
+        running = list(range(len(self.agents))) if self.max_steps > 0 else []
+        while running:
+            actions = self.batch.choose_actions([states[k] for k in running], running)
+            states_prime = [self.environments[k].next_state(states[k], a) for k, a in zip(running, actions)]
+            self.batch.update([states[k] for k in running], actions, states_prime, running)
+            finished = set()
+            for k, s_prime in zip(running, states_prime):
+                states[k] = s_prime
+                self.steps[k] += 1
+                if self.steps[k] % (len(self.agents[k].samples) + 2) == 0:
+                    logging.info('Agent {} finished interval {}'.format(k, self.intervals[k]))
+                    self.intervals[k] += 1
+                    self.agents[k].plan()
+                    if self.steps[k] >= self.max_steps:
+                        finished.add(k)
+            running = [k for k in running if k not in finished]
@@ -1,9 +1,11 @@
 import logging
 
+import numpy as np
+
 
 class Experiment2:
 
-    def __init__(self, agent, environment, interval_length, steps, viz_steps):
+    def __init__(self, agent, environment, interval_length, steps, viz_steps, checkpoint_every=None, checkpoint_path=None):
         self.interval_length = interval_length
         self.max_steps = steps
         self.step = 0
@@ -11,12 +13,37 @@ class Experiment2:
         self.agent = agent
         self.environment = environment
         self.viz_steps = viz_steps
+        # Unless checkpoint_every is None, the agent and the experiment's progress are saved to checkpoint_path after the
+        # first plan at least checkpoint_every steps after the last checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_step = 0
+        self.s = None
 
     def run(self):
-        self.s = self.environment.initial_state()
+        if self.s is None:
+            self.s = self.environment.initial_state()
         while self.step < self.max_steps:
             self.run_interval()
             self.agent.plan()
+            if self.checkpoint_every and self.step - self.checkpoint_step >= self.checkpoint_every:
+                self.checkpoint()
+
+    def checkpoint(self):
+        """Save the agent with the experiment's progress and current state to checkpoint_path."""
+        state = self.s if isinstance(self.s, int) else np.asarray(self.s).tolist()
+        self.agent.save(self.checkpoint_path, {'step': self.step, 'interval': self.interval, 'state': state})
+        self.checkpoint_step = self.step
+        logging.info('Saved checkpoint at step {} to {}'.format(self.step, self.checkpoint_path))
+
+    def resume(self, path):
+        """Load the agent and the experiment's progress and current state from the checkpoint at path, so that run
+        continues where the checkpointed run left off."""
+        progress = self.agent.load(path)
+        self.step = self.checkpoint_step = progress['step']
+        self.interval = progress['interval']
+        self.s = progress['state'] if isinstance(progress['state'], int) else np.asarray(progress['state'])
+        logging.info('Resumed from checkpoint {} at step {}'.format(path, self.step))
 
 
     def run_interval(self):
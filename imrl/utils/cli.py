@@ -14,11 +14,14 @@ from imrl.agent.agent import Agent
 from imrl.agent.policy.policy_random import RandomPolicy, RandomOptionPolicy
 from imrl.agent.fa.tabular import TabularFA
 from imrl.agent.fa.rbf import RBF
+from imrl.agent.fa.tile_coding import TileCoding
+from imrl.agent.fa.cached import CachedFA
 from imrl.environment.gridworld import Gridworld
 from imrl.environment.gridworld_continuous import GridworldContinuous
 from imrl.environment.combination_lock import CombinationLock
 from imrl.utils.results_writer import ResultsDescriptor
 from imrl.interface.experiment2 import Experiment2
+from imrl.interface.batch_experiment import BatchExperiment
 
 
 def parse_args(argv):
@@ -29,6 +32,8 @@ def parse_args(argv):
     gamma = 0.99
     epsilon = 0.1
     beta = 80
+    fa_resolution = 5
+    num_tilings = 8
     plan_interval = 10
     num_vi = 1
     retain_theta = True
@@ -49,6 +54,14 @@ def parse_args(argv):
     parser.add_argument('--num_steps', help='Number of steps for which to run the experiment.', type=int, default=10000)
     parser.add_argument('--log_level', help='Set log level.', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='WARNING')
     parser.add_argument('--results_interval', help='Log results out to terminal and file every n intervals.', type=int, default=50)
+    parser.add_argument('--checkpoint_every', help='Save a checkpoint of the agent to checkpoint_path at the first plan at least this '
+                        'many steps after the last one.', type=int)
+    parser.add_argument('--checkpoint_path', help='Directory of the checkpoint. Default is checkpoint in the current working directory.',
+                        default=os.path.join(os.getcwd(), 'checkpoint'))
+    parser.add_argument('--resume', help='Resume the run saved in the given checkpoint directory. The other arguments must match '
+                        'those of the checkpointed run.')
+    parser.add_argument('--batch_seeds', help='Run this many agents with consecutive seeds from --seed in lockstep, updating them '
+                        'together at every step. Each agent still plans on its own. Requires dense option storage.', type=int, default=1)
     parser.add_argument('--results_path', help='File path to save the results to. Default is results.txt in the current working directory.',
                         default=os.path.join(os.getcwd(), 'results.txt'))
 
@@ -58,12 +71,46 @@ def parse_args(argv):
     parser.add_argument('--gamma', help='Discount factor.', type=float, default=gamma)
     parser.add_argument('--epsilon', help='New state sample distance threshold', type=float, default=epsilon)
     parser.add_argument('--zeta', help='Intrinsic reward decay parameter.', type=float, default=zeta)
+    parser.add_argument('--fa', help='Function approximator. Defaults to tabular for discrete environments and rbf otherwise.',
+                        choices=['tabular', 'rbf', 'tile'])
+    parser.add_argument('--fa_resolution', help='Number of RBF kernels or tiles along each state dimension.', type=int, default=fa_resolution)
     parser.add_argument('--beta', help='RBF kernel width parameter.', type=float, default=beta)
+    parser.add_argument('--rbf_cutoff', help='Truncate RBF kernels further than this radius from the state to sparse features.', type=float)
+    parser.add_argument('--num_tilings', help='Number of offset tilings used by tile coding.', type=int, default=num_tilings)
+    parser.add_argument('--tile_memory', help='Hash tiles into this many features instead of giving each tile its own.', type=int)
+    parser.add_argument('--fa_cache', help='Cache the feature vectors of up to this many recently evaluated states. 0 disables the cache.',
+                        type=int, default=0)
+    parser.add_argument('--fa_cache_quantum', help='Share cached feature vectors between continuous states that round to the same '
+                        'multiple of this value.', type=float)
     parser.add_argument('--plan_interval', help='Execute value iteration after every n steps', type=int, default=plan_interval)
-    parser.add_argument('--num_vi', help='Number of iterations of value iteration to perform.', type=int, default=num_vi)
+    parser.add_argument('--plan_workers', help='Plan and simulate the subgoal options concurrently in this many forked processes. 0 plans them '
+                        'serially.', type=int, default=0)
+    parser.add_argument('--plan_threshold', help='Only replan the options with new samples or model updates of more than this total '
+                        'magnitude since they were last planned. By default every option is replanned.', type=float)
+    parser.add_argument('--num_vi', help='Number of iterations of value iteration to perform, the cap if --vi_tol is given.', type=int,
+                        default=num_vi)
+    parser.add_argument('--vi_tol', help='Stop value iteration once the residual of a sweep falls below this tolerance.', type=float)
+    parser.add_argument('--vi_norm', help='Norm of the Bellman errors of a sweep used as its residual.', choices=['max', 'l2'], default='max')
+    parser.add_argument('--vi_ordering', help='Back up the samples of a value iteration sweep one at a time (gauss_seidel) or all at '
+                        'once from the same value function (jacobi), use prioritized sweeping (prioritized) or, for tabular features, solve exactly by '
+                        'policy iteration (policy_iteration).', choices=['gauss_seidel', 'jacobi', 'prioritized', 'policy_iteration'],
+                        default='gauss_seidel')
+    parser.add_argument('--vi_budget', help='Maximum number of backups per prioritized sweeping run. Defaults to --num_vi times the '
+                        'number of samples.', type=int)
     parser.add_argument("--retain_theta", action='store_true', default=retain_theta, help="Retain previous value function estimate for VI.")
     parser.add_argument('--sim_samples', help='Number of sample start states from which to simulate options.', type=int, default=sim_samples)
+    parser.add_argument('--sim_batched', help='Simulate each option from all of its start samples together.', action='store_true')
     parser.add_argument('--sim_steps', help='Number of for which to simulate options.', type=int, default=sim_steps)
+    parser.add_argument('--option_storage', help='Storage backend for the option models M and U.', choices=['dense', 'sparse', 'low_rank', 'memmap'],
+                        default='dense')
+    parser.add_argument('--option_dir', help='Directory of the files of the memmap option model storage. Default is a new temporary '
+                        'directory.')
+    parser.add_argument('--option_rank', help='Rank kept by the low_rank option model storage.', type=int, default=20)
+    parser.add_argument('--replay_capacity', help='Keep this many past transitions and replay a mini-batch of them into the '
+                        'option models at every plan. 0 disables replay.', type=int, default=0)
+    parser.add_argument('--replay_batch', help='Number of transitions replayed at every plan.', type=int, default=256)
+    parser.add_argument('--dtype', help='Floating point precision of the features, option models and value functions. float32 halves '
+                        'their memory and bandwidth.', choices=['float32', 'float64'], default='float64')
     parser.add_argument('--agent_policy', help='Choose the agent\'s initial policy.', choices=['random'], default='random')
     parser.add_argument("--agent_viz", action='store_true', default=agent_viz, help="Plot agent statistics during runs?")
     parser.add_argument('--viz_steps', help='Frequency with which to update agent visualization.', type=int, default=viz_steps)
@@ -90,31 +137,65 @@ def log_level(level_string):
         return logging.ERROR
 
 
+def create_environment(args):
+    """Create the environment chosen by the arguments."""
+    return (args.environment == 'gridworld' and Gridworld(args.gridworld_width, args.gridworld_height, args.failure_rate)) or \
+           (args.environment == 'gridworld_continuous' and GridworldContinuous(0.2, 0.01)) or \
+           (args.environment == 'combo_lock' and CombinationLock(args.gridworld_height, args.gridworld_width, 4, args.failure_rate))
+
+
+def create_agent(args, environment, discrete):
+    """Create the agent and function approximator chosen by the arguments for the environment."""
+    policy = (args.agent_policy == 'random' and RandomPolicy(environment.num_actions))
+    fa_name = args.fa or (discrete and 'tabular') or 'rbf'
+    assert discrete == (fa_name == 'tabular'), 'Tabular function approximation is only available for discrete environments.'
+    assert args.vi_ordering != 'policy_iteration' or fa_name == 'tabular', 'Policy iteration requires tabular function approximation.'
+    fa = (fa_name == 'tabular' and TabularFA(environment.num_states(), environment.num_actions, dtype=args.dtype)) or \
+        (fa_name == 'rbf' and RBF(2, args.fa_resolution, environment.num_actions, beta=args.beta, cutoff=args.rbf_cutoff, dtype=args.dtype)) or \
+        (fa_name == 'tile' and TileCoding(2, args.fa_resolution, args.num_tilings, environment.num_actions, memory_size=args.tile_memory,
+                                          dtype=args.dtype))
+    if args.fa_cache > 0:
+        fa = CachedFA(fa, args.fa_cache, args.fa_cache_quantum)
+    # Tile coding activates num_tilings binary features at once, so each step size is shared among them
+    step_scale = 1.0 / args.num_tilings if fa_name == 'tile' else 1.0
+    agent = Agent(policy, fa, environment.num_actions, args.alpha * step_scale, args.gamma, args.eta * step_scale,
+                  args.zeta * step_scale, args.epsilon, args.num_vi, args.sim_samples, args.sim_steps, retain_theta=args.retain_theta, subgoals=environment.create_subgoals(),
+                  option_storage=args.option_storage, option_rank=args.option_rank, option_dir=args.option_dir, replay_capacity=args.replay_capacity,
+                  replay_batch=args.replay_batch, vi_ordering=args.vi_ordering,
+                  vi_tolerance=args.vi_tol, vi_residual_norm=args.vi_norm, vi_budget=args.vi_budget,
+                  plan_workers=args.plan_workers, plan_threshold=args.plan_threshold, sim_batched=args.sim_batched)
+    agent.policy = RandomOptionPolicy(agent, args.random_options)
+    return agent, fa
+
+
 def main(argv):
     """Execute experiment."""
     args = parse_args(argv)
     random.seed(args.seed)
     logging.basicConfig(level=log_level(args.log_level))
-    environment = (args.environment == 'gridworld' and Gridworld(args.gridworld_width, args.gridworld_height, args.failure_rate)) or \
-                  (args.environment == 'gridworld_continuous' and GridworldContinuous(0.2, 0.01)) or \
-                  (args.environment == 'combo_lock' and CombinationLock(args.gridworld_height, args.gridworld_width, 4, args.failure_rate))
-    policy = (args.agent_policy == 'random' and RandomPolicy(environment.num_actions))
-    fa = ((args.environment == 'gridworld' or args.environment == 'combo_lock') and
-          TabularFA(environment.num_states(), environment.num_actions)) or \
-        (args.environment == 'gridworld_continuous' and RBF(2, 5, environment.num_actions, beta=args.beta))
-    agent = Agent(policy, fa, environment.num_actions, args.alpha, args.gamma, args.eta, args.zeta, args.epsilon,
-                  args.num_vi, args.sim_samples, args.sim_steps, retain_theta=args.retain_theta, subgoals=environment.create_subgoals())
-    agent.policy = RandomOptionPolicy(agent, args.random_options)
+    discrete = args.environment == 'gridworld' or args.environment == 'combo_lock'
+    if args.batch_seeds > 1:
+        seeds = [(args.seed or 0) + k for k in range(args.batch_seeds)]
+        environments = [create_environment(args) for _ in seeds]
+        agents = [create_agent(args, environment, discrete)[0] for environment in environments]
+        BatchExperiment(agents, environments, args.num_steps, seeds).run()
+        return
+    environment = create_environment(args)
+    agent, fa = create_agent(args, environment, discrete)
     if args.agent_viz:
-        agent.create_visualization(args.environment == 'gridworld' or args.environment == 'combo_lock', environment)
+        agent.create_visualization(discrete, environment)
     # agent.exploit(np.asarray([1, 1]))
     # agent.exploit(environment.num_states()-1)
     # results_descriptor = ResultsDescriptor(args.results_interval, args.results_path, ['interval_id', 'steps'])
     # experiment_descriptor = ExperimentDescriptor(args.plan_interval, args.num_steps)
     # start(experiment_descriptor, agent, environment, results_descriptor)
-    e = Experiment2(agent, environment, args.plan_interval, args.num_steps, args.viz_steps)
+    e = Experiment2(agent, environment, args.plan_interval, args.num_steps, args.viz_steps, args.checkpoint_every,
+                    args.checkpoint_path)
+    if args.resume:
+        e.resume(args.resume)
     e.run()
-
+    if isinstance(fa, CachedFA):
+        logging.info('Feature cache hits: {}, misses: {}'.format(fa.hits, fa.misses))
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -1,10 +1,263 @@
 """Convenience linear algebra functions."""
 
 import numpy as np
+from scipy.linalg.blas import get_blas_funcs
 
 
-def one_hot_vector(length, position):
+def one_hot_vector(length, position, dtype=np.float64):
     """Return a \"one-hot\" float vector of given length that is all 0's except for a 1 in the given position."""
-    zero_vector = np.zeros((length, 1))
+    zero_vector = np.zeros((length, 1), dtype=dtype)
     zero_vector[position, 0] = 1.0
     return zero_vector
+
+
+class SparseVector(object):
+    """Column vector of the given length that is zero everywhere except at the (unique) indices, where it takes values."""
+
+    def __init__(self, indices, values, length, dtype=np.float64):
+        self.indices = np.asarray(indices, dtype=int)
+        self.values = np.asarray(values, dtype=dtype)
+        self.length = length
+
+    @property
+    def shape(self):
+        return self.length, 1
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    def to_dense(self):
+        fv = np.zeros((self.length, 1), dtype=self.dtype)
+        fv[self.indices, 0] = self.values
+        return fv
+
+    def __array__(self, dtype=None, copy=None):
+        fv = self.to_dense()
+        return fv if dtype is None else fv.astype(dtype)
+
+    def __repr__(self):
+        return "SparseVector({}, {}, {})".format(self.indices.tolist(), self.values.tolist(), self.length)
+
+
+class OneHotVector(SparseVector):
+    """Sparse column vector with a single 1 at the given index, so products with it reduce to row/column reads."""
+
+    def __init__(self, index, length, dtype=np.float64):
+        self.index = index
+        self.length = length
+        self._dtype = np.dtype(dtype)
+        self._indices = None
+        self._values = None
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def indices(self):
+        if self._indices is None:
+            self._indices = np.asarray([self.index])
+        return self._indices
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = np.ones(1, dtype=self._dtype)
+        return self._values
+
+    def __repr__(self):
+        return "OneHotVector({}, {})".format(self.index, self.length)
+
+
+class StateActionVector(object):
+    """Feature vector of a state-action pair. Places the state feature vector fv (dense or sparse) in the block of the given
+    action within a vector of num_actions such blocks, without copying fv. Entries can be read by index."""
+
+    def __init__(self, fv, action, num_actions):
+        assert 0 <= action < num_actions
+        self.fv = fv
+        self.action = action
+        self.num_actions = num_actions
+        self.block_length = fv.shape[0]
+        self.offset = action * self.block_length
+        self.length = num_actions * self.block_length
+
+    @property
+    def shape(self):
+        return self.length, 1
+
+    @property
+    def dtype(self):
+        return self.fv.dtype
+
+    @property
+    def block(self):
+        """The slice of a state-action indexed array that lines up with this action's block."""
+        return slice(self.offset, self.offset + self.block_length)
+
+    def __getitem__(self, i):
+        if not self.offset <= i < self.offset + self.block_length:
+            return 0.0
+        i -= self.offset
+        if isinstance(self.fv, SparseVector):
+            matches = np.flatnonzero(self.fv.indices == i)
+            return float(self.fv.values[matches[0]]) if len(matches) else 0.0
+        return float(self.fv[i, 0])
+
+    def to_dense(self):
+        sa_fv = np.zeros((self.length, 1), dtype=self.dtype)
+        sa_fv[self.block] = dense(self.fv)
+        return sa_fv
+
+    def __array__(self, dtype=None, copy=None):
+        sa_fv = self.to_dense()
+        return sa_fv if dtype is None else sa_fv.astype(dtype)
+
+    def __repr__(self):
+        return "StateActionVector({!r}, {}, {})".format(self.fv, self.action, self.num_actions)
+
+
+def dense(fv):
+    """Return the given feature vector as a dense column vector."""
+    return fv.to_dense() if isinstance(fv, (SparseVector, StateActionVector)) else fv
+
+
+def sparse_entries(fv):
+    """Return the arrays of indices and values of the nonzero entries of a feature vector, dense or sparse."""
+    if isinstance(fv, StateActionVector):
+        indices, values = sparse_entries(fv.fv)
+        return indices + fv.offset, values
+    if isinstance(fv, SparseVector):
+        return fv.indices, fv.values
+    indices = np.flatnonzero(fv[:, 0])
+    return indices, fv[indices, 0]
+
+
+def norm(fv):
+    """Return the Euclidean norm of a feature vector, reading only the nonzero entries of a sparse fv."""
+    if isinstance(fv, OneHotVector):
+        return 1.0
+    values = sparse_entries(fv)[1] if isinstance(fv, (SparseVector, StateActionVector)) else fv.ravel()
+    return float(np.sqrt(np.dot(values, values)))
+
+
+def inner(x, fv):
+    """Compute x^T fv for a dense column vector (or matrix of columns) x, reading only the nonzero entries of a sparse fv."""
+    if isinstance(fv, StateActionVector):
+        return inner(x[fv.block], fv.fv)
+    if isinstance(fv, OneHotVector):
+        return x[fv.index:fv.index + 1].T.copy()
+    if isinstance(fv, SparseVector):
+        return np.dot(x[fv.indices].T, fv.values[:, np.newaxis])
+    return np.dot(x.T, fv)
+
+
+def matvec(a, fv, out=None):
+    """Compute a fv, reading only the columns of a at the nonzero entries of a sparse fv.
+    If given, the result is written into the preallocated column vector out."""
+    if isinstance(fv, StateActionVector):
+        return matvec(a[:, fv.block], fv.fv, out)
+    if isinstance(fv, OneHotVector):
+        if out is None:
+            return a[:, fv.index:fv.index + 1].copy()
+        np.copyto(out, a[:, fv.index:fv.index + 1])
+        return out
+    if isinstance(fv, SparseVector):
+        return np.dot(a[:, fv.indices], fv.values[:, np.newaxis], out=out)
+    return np.dot(a, fv, out=out)
+
+
+def batch_matvec(a_t, fv):
+    """Given a (k, n, n) stack of transposed matrices, return the (k, n) array whose row i is a_t[i].T fv, the product of
+    the i-th matrix with fv. For one-hot fv the result is a view into the stack."""
+    if isinstance(fv, OneHotVector):
+        return a_t[:, fv.index, :]
+    if isinstance(fv, SparseVector):
+        return np.matmul(fv.values, a_t.take(fv.indices, axis=1))
+    return np.matmul(fv[:, 0], a_t)
+
+
+def batch_tmatvec(a_t, fv):
+    """Given a (k, n, n) stack of transposed matrices, return the (k, n) array whose row i is a_t[i] fv, the product of
+    the transpose of the i-th matrix with fv."""
+    if isinstance(fv, OneHotVector):
+        return a_t[:, :, fv.index]
+    if isinstance(fv, SparseVector):
+        return np.matmul(a_t[:, :, fv.indices], fv.values)
+    return np.matmul(a_t, fv)[:, :, 0]
+
+
+def add_scaled(x, fv, scale):
+    """Add scale * fv to the dense column vector x in place and return x."""
+    if isinstance(fv, StateActionVector):
+        add_scaled(x[fv.block], fv.fv, scale)
+    elif isinstance(fv, OneHotVector):
+        x[fv.index, 0] += scale
+    elif isinstance(fv, SparseVector):
+        x[fv.indices, 0] += scale * fv.values
+    else:
+        x += scale * fv
+    return x
+
+
+def relax(x, fv, scale, rate):
+    """Move the 1-d array x in place toward scale * fv by the fraction rate, as x += rate * (scale * fv - x), and return
+    the norm of scale * fv - x before the move. A sparse fv is only read at its nonzero entries."""
+    if isinstance(fv, OneHotVector):
+        squared = np.dot(x, x) + scale * (scale - 2.0 * x[fv.index])
+        x *= 1.0 - rate
+        x[fv.index] += rate * scale
+    else:
+        indices, values = sparse_entries(fv)
+        target = scale * values
+        squared = np.dot(x, x) + np.dot(target, target) - 2.0 * np.dot(x[indices], target)
+        x *= 1.0 - rate
+        x[indices] += rate * target
+    return float(np.sqrt(max(squared, 0.0)))
+
+
+def add_outer(a, x, fv, scale):
+    """Add the rank-1 update scale * x fv^T to the matrix a in place and return a.
+    Only the columns of a at the nonzero entries of a sparse fv are touched."""
+    if isinstance(fv, StateActionVector):
+        add_outer(a[:, fv.block], x, fv.fv, scale)
+    elif isinstance(fv, OneHotVector):
+        axpy(a[:, fv.index], x.ravel(), scale)
+    elif isinstance(fv, SparseVector):
+        a[:, fv.indices] += scale * np.dot(x, fv.values[np.newaxis, :])
+    else:
+        ger(a, x.ravel(), fv.ravel(), scale)
+    return a
+
+
+def blas_function(name, a):
+    """Look up the BLAS routine name for the dtype of array a, caching the lookup."""
+    key = (name, a.dtype.char)
+    if key not in _blas_functions:
+        _blas_functions[key] = get_blas_funcs(name, (a,))
+    return _blas_functions[key]
+
+
+_blas_functions = {}
+
+
+def ger(a, x, y, scale):
+    """Accumulate scale * x y^T into the matrix a in place through BLAS ger, without allocating the outer product.
+    x and y are 1-d. Matrices that are neither row- nor column-major fall back to numpy."""
+    if a.flags.f_contiguous:
+        blas_function('ger', a)(scale, x, y, a=a, overwrite_a=True)
+    elif a.flags.c_contiguous:
+        blas_function('ger', a)(scale, y, x, a=a.T, overwrite_a=True)
+    else:
+        a += scale * np.outer(x, y)
+    return a
+
+
+def axpy(y, x, scale):
+    """Accumulate scale * x into the 1-d array y in place through BLAS axpy. Strided y falls back to numpy."""
+    if y.flags.contiguous and x.dtype == y.dtype:
+        blas_function('axpy', y)(x, y, a=scale)
+    else:
+        y += scale * x
+    return y
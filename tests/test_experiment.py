@@ -17,13 +17,21 @@
 
 # System
 import os
+import random
+
+# Third party
+import numpy as np
 
 # First party
 from imrl.interface.experiment import start, ExperimentDescriptor
+from imrl.interface.experiment2 import Experiment2
+from imrl.interface.batch_experiment import BatchExperiment
 from imrl.environment.gridworld import Gridworld
+from imrl.environment.gridworld_continuous import GridworldContinuous
 from imrl.agent.agent import Agent
 from imrl.agent.fa.tabular import TabularFA
-from imrl.agent.policy.policy_random import RandomPolicy
+from imrl.agent.fa.rbf import RBF
+from imrl.agent.policy.policy_random import RandomPolicy, RandomOptionPolicy
 from imrl.utils.results_writer import ResultsDescriptor
 
 
@@ -36,3 +44,72 @@ def test_discrete_gridworld_experiment():
     results_path = os.path.join(os.getcwd(), 'results.txt')
     results_descriptor = ResultsDescriptor(100, results_path, ['interval_id', 'steps'])
     start(experiment_description, agent, environment, results_descriptor)
+
+
+
+def checkpointed_run(path, environment, fa, steps, resume_at=None, **kwargs):
+    """Run an experiment for the given number of steps and return its agent. If resume_at is given, the run is stopped at
+    its first checkpoint after resume_at steps and resumed from it with a new agent."""
+    def experiment(max_steps):
+        agent = Agent(None, fa, environment.num_actions, 0.1, 0.99, 0.1, 0.1, 0.1, 1, 5, 10,
+                      subgoals=environment.create_subgoals(), samples=[], **kwargs)
+        agent.policy = RandomOptionPolicy(agent, False)
+        return Experiment2(agent, environment, 10, max_steps, 10 ** 9, resume_at, path)
+
+    random.seed(0)
+    np.random.seed(0)
+    e = experiment(steps)
+    if resume_at is not None:
+        experiment(resume_at).run()
+        random.seed(1)  # The random states are restored from the checkpoint
+        np.random.seed(1)
+        e.resume(path)
+    e.run()
+    return e.agent
+
+
+def test_checkpoint_resume(tmp_path):
+    """Does a run resumed from a checkpoint learn exactly what the uninterrupted run learns?"""
+    path = str(tmp_path / 'checkpoint')
+    for environment, fa, kwargs in [(Gridworld(5, 5, 0.1), TabularFA(25, 4), {}),
+                                    (Gridworld(5, 5, 0.1), TabularFA(25, 4), {'vi_ordering': 'prioritized'}),
+                                    (Gridworld(5, 5, 0.1), TabularFA(25, 4), {'plan_threshold': 50, 'vi_ordering': 'prioritized'}),
+                                    (GridworldContinuous(0.2, 0.01), RBF(2, 3, 4), {'option_storage': 'sparse', 'replay_capacity': 50})]:
+        a = checkpointed_run(path, environment, fa, 200, **kwargs)
+        b = checkpointed_run(path, environment, fa, 200, 80, **kwargs)
+        assert b.step == a.step and len(b.options) == len(a.options) > a.num_actions
+        assert np.array_equal(np.asarray(b.samples), np.asarray(a.samples)) and b.sample_rows == a.sample_rows
+        assert np.array_equal(b.vi.theta, a.vi.theta)
+        for i in a.options:
+            assert np.array_equal(b.options[i].m_model.to_dense(), a.options[i].m_model.to_dense())
+            assert np.array_equal(b.options[i].u_model.to_dense(), a.options[i].u_model.to_dense())
+            assert np.array_equal(b.intrinsic[i], a.intrinsic[i])
+
+
+def test_batch_experiment():
+    """Do agents run in lockstep learn exactly what they learn when run one by one with the same seeds?"""
+    def agent_and_environment():
+        environment = Gridworld(5, 5, 0.1)
+        agent = Agent(None, TabularFA(25, 4), 4, 0.1, 0.99, 0.1, 0.1, 0.1, 1, 5, 10,
+                      subgoals=environment.create_subgoals(), samples=[])
+        agent.policy = RandomOptionPolicy(agent, False)
+        return agent, environment
+
+    seeds = [0, 1, 2]
+    serial = []
+    for seed in seeds:
+        random.seed(seed)
+        np.random.seed(seed)
+        agent, environment = agent_and_environment()
+        Experiment2(agent, environment, 10, 300, 10 ** 9).run()
+        serial.append(agent)
+    agents, environments = zip(*[agent_and_environment() for _ in seeds])
+    BatchExperiment(list(agents), list(environments), 300, seeds).run()
+    for a, b in zip(serial, agents):
+        assert b.step == a.step and len(b.options) == len(a.options)
+        assert np.allclose(b.vi.theta, a.vi.theta, rtol=0, atol=1e-12)
+        for i in a.options:
+            assert np.allclose(b.options[i].m_model.to_dense(), a.options[i].m_model.to_dense(), rtol=0, atol=1e-12)
+            assert np.allclose(b.options[i].u_model.to_dense(), a.options[i].u_model.to_dense(), rtol=0, atol=1e-12)
+            assert np.allclose(b.intrinsic[i], a.intrinsic[i], rtol=0, atol=1e-12)
+    assert not np.allclose(serial[0].vi.theta, serial[1].vi.theta)
@@ -7,6 +7,9 @@ import numpy as np
 from imrl.agent.fa.tabular import TabularFA
 from imrl.environment.gridworld import GridPosition
 from imrl.agent.fa.rbf import RBF
+from imrl.agent.fa.tile_coding import TileCoding
+from imrl.agent.fa.cached import CachedFA
+from imrl.utils.linear_algebra import SparseVector, one_hot_vector, inner, add_scaled
 
 
 def test_tabular_function_approximator():
@@ -28,3 +31,94 @@ def test_rbfs():
     assert abs(1 - fv[0]) < 0.00001
     print(abs(fv[-1]))
     assert abs(fv[-1]) < 0.000001
+
+
+def test_rbf_batch():
+    """Does the batched RBF evaluation match the kernels evaluated one center at a time?"""
+    rbfs = RBF(2, 5, 4, beta=80)
+    states = np.asarray([[0, 0], [0.3, 0.7], [1, 0.5]])
+    fm = rbfs.evaluate_batch(states)
+    assert fm.shape == (3, 25)
+    for s, row in zip(states, fm):
+        expected = [np.exp(-80 * np.linalg.norm(c - s, 2) ** 2) for c in rbfs.centers]
+        assert np.allclose(row, expected)
+        assert np.allclose(rbfs.evaluate(s)[:, 0], row)
+    tabular = TabularFA(9, 4)
+    assert np.array_equal(tabular.evaluate_batch([3, 1]), np.hstack([np.asarray(tabular.evaluate(3)), np.asarray(tabular.evaluate(1))]).T)
+
+
+def test_truncated_rbfs():
+    """Do truncated RBFs return sparse features that match the dense kernels inside the cutoff radius?"""
+    dense_rbfs = RBF(2, 5, 4, beta=80)
+    sparse_rbfs = RBF(2, 5, 4, beta=80, cutoff=0.3)
+    s = np.asarray([0.4, 0.6])
+    fv = sparse_rbfs.evaluate(s)
+    assert isinstance(fv, SparseVector)
+    assert 0 < len(fv.indices) < sparse_rbfs.num_features
+    expected = dense_rbfs.evaluate(s)
+    expected[np.linalg.norm(dense_rbfs.centers - s, axis=1) > 0.3] = 0.0
+    assert np.allclose(np.asarray(fv), expected)
+    assert np.allclose(sparse_rbfs.evaluate_batch([s]).T, expected)
+
+
+def test_tile_coding():
+    """Does tile coding activate exactly one binary feature per tiling, shared by nearby states?"""
+    tiles = TileCoding(2, 5, 8, 4)
+    fv = tiles.evaluate(np.asarray([0.31, 0.62]))
+    assert len(set(fv.indices)) == 8
+    assert np.array_equal(fv.values, np.ones(8))
+    assert np.all(fv.indices < tiles.num_features)
+    near = tiles.evaluate(np.asarray([0.32, 0.62]))
+    far = tiles.evaluate(np.asarray([0.9, 0.1]))
+    assert len(set(fv.indices) & set(near.indices)) > 4
+    assert not set(fv.indices) & set(far.indices)
+    assert np.array_equal(tiles.evaluate_batch([np.asarray([0.31, 0.62])]).T, np.asarray(fv))
+
+    hashed = TileCoding(2, 50, 8, 4, memory_size=1024)
+    assert hashed.num_features == 1024
+    for s in np.random.rand(20, 2):
+        indices = hashed.evaluate(s).indices
+        assert len(set(indices)) == 8 and np.all(indices < 1024)
+
+
+def test_cached_fa():
+    """Does the cache return the wrapped feature vectors, count hits and misses and evict the least recently used state?"""
+    cached = CachedFA(RBF(2, 5, 4), capacity=2)
+    s1, s2, s3 = np.asarray([0.1, 0.2]), np.asarray([0.5, 0.5]), np.asarray([0.9, 0.3])
+    fv1 = cached.evaluate(s1)
+    assert np.array_equal(fv1, cached.fa.evaluate(s1))
+    assert cached.evaluate(s1.copy()) is fv1
+    cached.evaluate(s2)
+    cached.evaluate(s1)
+    cached.evaluate(s3)  # Evicts s2, the least recently used state
+    assert (cached.hits, cached.misses) == (2, 3)
+    assert cached.evaluate(s1) is fv1
+    cached.evaluate(s2)
+    assert (cached.hits, cached.misses) == (3, 4)
+    assert cached.dim == 2
+
+    tabular = CachedFA(TabularFA(9, 4))
+    assert tabular.evaluate(3) is tabular.evaluate(3)
+    quantized = CachedFA(RBF(2, 5, 4), quantum=0.01)
+    assert quantized.evaluate(np.asarray([0.1, 0.2])) is quantized.evaluate(np.asarray([0.1001, 0.2]))
+
+
+def test_state_action_features():
+    """Are state-action features views over the state features placed in the action's block?"""
+    tabular = TabularFA(9, 4)
+    sa_fv = tabular.evaluate_state_action(3, 2)
+    assert sa_fv.shape == (36, 1)
+    assert sa_fv[2 * 9 + 3] == 1.0 and sa_fv[3] == 0.0 and sa_fv[2 * 9 + 4] == 0.0
+    assert np.array_equal(np.asarray(sa_fv), one_hot_vector(36, 2 * 9 + 3))
+
+    rbfs = RBF(2, 5, 4, beta=80, cutoff=0.3)
+    s = np.asarray([0.4, 0.6])
+    fv = rbfs.evaluate(s)
+    sa_fv = rbfs.augment_with_action(fv, 1)
+    assert sa_fv.fv is fv
+    assert sa_fv[25 + fv.indices[0]] == fv.values[0]
+    q_weights = np.random.rand(rbfs.size, 1)
+    assert np.allclose(inner(q_weights, sa_fv), np.dot(q_weights.T, np.asarray(sa_fv)))
+    expected = q_weights + 0.5 * np.asarray(sa_fv)
+    add_scaled(q_weights, sa_fv, 0.5)
+    assert np.allclose(q_weights, expected)
@@ -0,0 +1,24 @@
+"""Test the index of the agent's state samples."""
+
+# Third party
+import numpy as np
+
+# First party
+from imrl.agent.sample_store import SampleStore
+
+
+def test_sample_store():
+    """Does the sample store find the first added sample within epsilon, as a linear scan would, and keep discrete
+    samples sorted?"""
+    rng = np.random.RandomState(0)
+    store = SampleStore(0.05)
+    for i, state in enumerate(rng.rand(500, 2)):
+        within = [j for j, s in enumerate(store) if np.linalg.norm(s - state) <= 0.05]
+        assert store.find(state) == (store.rows[within[0]] if within else None)
+        if not within:
+            store.add(state, i)
+    store = SampleStore(0.05)
+    for i, state in enumerate([5, 2, 7, 3]):
+        store.add(state, i)
+    assert list(store) == [2, 3, 5, 7] and store.rows == [1, 3, 0, 2]
+    assert store.find(7) == 2 and store.find(4) is None and store.index(5) == 2
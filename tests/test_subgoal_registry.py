@@ -0,0 +1,27 @@
+"""Test the index of the candidate subgoals."""
+
+# Third party
+import numpy as np
+
+# First party
+from imrl.agent.subgoal_registry import SubgoalRegistry
+from imrl.agent.option.option import Subgoal
+
+
+def test_subgoal_registry():
+    """Does the subgoal registry reach the first unreached subgoal within its radius of a state, as a scan of the
+    subgoals would, and reach discrete subgoals by their state?"""
+    rng = np.random.RandomState(0)
+    subgoals = [Subgoal(c, r) for c, r in zip(rng.rand(300, 2), rng.uniform(0.01, 0.05, 300))]
+    registry = SubgoalRegistry(subgoals)
+    reached = []
+    for state in rng.rand(2000, 2):
+        expected = next((g for g in subgoals if np.linalg.norm(g.state - state) <= g.radius and
+                         not any(g is h for h in reached)), None)
+        assert registry.reach(state) is expected
+        if expected is not None:
+            reached.append(expected)
+    assert len(reached) > 10 and registry.reached_subgoals() == reached
+    registry = SubgoalRegistry([Subgoal(2), Subgoal(5), Subgoal(2)])
+    assert registry.reach(3) is None and registry.reach(2) is registry[0]
+    assert registry.reach(2) is None and registry.reached.tolist() == [True, False, True] and Subgoal(5) in registry
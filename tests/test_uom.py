@@ -1,5 +1,9 @@
 """Test the UOM learning."""
 
+# System
+import gc
+import os
+
 # Third party
 import numpy as np
 
@@ -7,7 +11,10 @@ import numpy as np
 from imrl.agent.option.option import Option
 from imrl.agent.policy.policy_fixed import FixedPolicy
 from imrl.agent.fa.tabular import TabularFA
+from imrl.agent.fa.rbf import RBF
 from imrl.agent.option.option import Subgoal
+from imrl.agent.replay import ReplayBuffer
+from tests.tools import explored_agent
 
 
 def test_uom_update():
@@ -27,3 +34,142 @@ def test_uom_update():
     identity = np.eye(9, 9)
     identity[2, 0] = option.eta * option.gamma
     assert np.array_equal(identity, u_prime)
+
+
+def test_sparse_uom_update():
+    """Do updates from sparse feature vectors match the updates from the equivalent dense feature vectors?"""
+    fa = RBF(2, 5, 4, beta=80, cutoff=0.3)
+    sparse_option = Option(0, fa, FixedPolicy(4, 0), 0.1, 0.99, None, 4)
+    dense_option = Option(0, fa, FixedPolicy(4, 0), 0.1, 0.99, None, 4)
+    for s, s_prime in [([0.1, 0.1], [0.1, 0.3]), ([0.1, 0.3], [0.5, 0.3]), ([0.5, 0.3], [0.5, 0.5])]:
+        fv = fa.evaluate(np.asarray(s))
+        fv_prime = fa.evaluate(np.asarray(s_prime))
+        sparse_option.update_m(fv, fv_prime, 1)
+        sparse_option.update_u(fv, fv_prime, False)
+        dense_option.update_m(np.asarray(fv), np.asarray(fv_prime), 1)
+        dense_option.update_u(np.asarray(fv), np.asarray(fv_prime), False)
+    assert np.allclose(sparse_option.m, dense_option.m)
+    assert np.allclose(sparse_option.u, dense_option.u)
+    r = np.ones((fa.num_features, 1))
+    assert np.allclose(sparse_option.get_return(r, fv), dense_option.get_return(r, np.asarray(fv)))
+
+
+def test_one_hot_uom_update():
+    """Do index-based updates from one-hot feature vectors match the dense updates?"""
+    one_hot_option = Option(0, TabularFA(9, 4), FixedPolicy(4, 0), 0.1, 0.99, None, 4)
+    dense_option = Option(0, TabularFA(9, 4, dense=True), FixedPolicy(4, 0), 0.1, 0.99, None, 4)
+    for state, state_prime in [(0, 1), (1, 2), (0, 1), (2, 2)]:
+        for option in [one_hot_option, dense_option]:
+            fv = option.fa.evaluate(state)
+            fv_prime = option.fa.evaluate(state_prime)
+            option.update_m(fv, fv_prime, 0)
+            option.update_u(fv, fv_prime, state_prime == 2)
+    assert np.allclose(one_hot_option.m, dense_option.m)
+    assert np.allclose(one_hot_option.u, dense_option.u)
+    assert np.isclose(one_hot_option.update_total, dense_option.update_total)
+    assert np.allclose(one_hot_option.get_next_fv(one_hot_option.fa.evaluate(1)), dense_option.m[:, 1:2])
+    for fa in [TabularFA(9, 4), TabularFA(9, 4, dense=True)]:
+        option = Option(5, fa, FixedPolicy(4, 0), 0.1, 0.99, Subgoal(4), 4)
+        assert [option.is_terminal(fa.evaluate(s)) for s in range(9)] == [s == 4 for s in range(9)]
+
+
+def test_in_place_uom_update():
+    """Do in-place updates reuse the M and U buffers while the copying mode returns new matrices with the same values?"""
+    fa = RBF(2, 3, 4)
+    in_place = Option(0, fa, FixedPolicy(4, 0), 0.1, 0.99, None, 4)
+    copying = Option(0, fa, FixedPolicy(4, 0), 0.1, 0.99, None, 4, in_place=False)
+    m, u = in_place.m, in_place.u
+    old_m, old_u = copying.m, copying.u
+    fv = fa.evaluate(np.asarray([0.2, 0.2]))
+    fv_prime = fa.evaluate(np.asarray([0.2, 0.4]))
+    assert in_place.update_m(fv, fv_prime, 1) is m
+    assert in_place.update_u(fv, fv_prime, False) is u
+    assert copying.update_m(fv, fv_prime, 1) is not old_m
+    assert copying.update_u(fv, fv_prime, False) is not old_u
+    assert not old_m.any() and np.array_equal(old_u, np.eye(9))
+    assert np.allclose(in_place.m, copying.m) and np.allclose(in_place.u, copying.u)
+
+
+def test_uom_storage_backends():
+    """Do the sparse and low-rank option model backends learn the same models as the dense one?
+    Only the columns of four states are updated, so the rank 4 model is recompressed without loss."""
+    fa = TabularFA(9, 4)
+    options = {storage: Option(0, fa, FixedPolicy(4, 0), 0.1, 0.99, None, 4, storage=storage, rank=4)
+               for storage in ['dense', 'sparse', 'low_rank']}
+    for state, state_prime in [(0, 1), (1, 2), (0, 1), (2, 5), (5, 8), (1, 2)]:
+        for option in options.values():
+            fv = fa.evaluate(state)
+            fv_prime = fa.evaluate(state_prime)
+            option.update_m(fv, fv_prime, 1)
+            option.update_u(fv, fv_prime, state_prime == 8)
+    dense = options['dense']
+    assert np.allclose(options['sparse'].m.toarray(), dense.m)
+    assert np.allclose(options['sparse'].u.toarray(), dense.u)
+    assert options['sparse'].u.nnz < 20
+    assert np.allclose(options['low_rank'].m, dense.m)
+    assert np.allclose(options['low_rank'].u, dense.u)
+    r = np.arange(9.0).reshape((9, 1))
+    for option in options.values():
+        assert np.allclose(option.get_next_fv(fa.evaluate(1)), dense.m[:, 1:2])
+        assert np.allclose(option.get_return(r, fa.evaluate(0)), dense.get_return(r, fa.evaluate(0)))
+
+
+def test_batch_uom_update():
+    """Does a mini-batch update move M and U by the mean of the updates each transition would make on its own?"""
+    grid = [([0.1, 0.1], [0.1, 0.3]), ([0.1, 0.3], [0.5, 0.3]), ([0.5, 0.3], [0.5, 0.5]), ([0.1, 0.1], [0.3, 0.1])]
+    cases = [(TabularFA(9, 4), [(0, 1), (1, 2), (0, 3), (2, 5)]), (RBF(2, 5, 4, beta=80, cutoff=0.3), grid), (RBF(2, 3, 4), grid)]
+    for fa, transitions in cases:
+        transitions = [(fa.evaluate(s if isinstance(s, int) else np.asarray(s)),
+                        fa.evaluate(s_prime if isinstance(s_prime, int) else np.asarray(s_prime))) for s, s_prime in transitions]
+        terminal = np.asarray([False, True, False, False])
+        buffer = ReplayBuffer(3, fa.num_features)
+        for (fv, fv_prime), t in zip(transitions, terminal):
+            buffer.add(0, fv, fv_prime, t)
+        assert len(buffer) == 3 and buffer.position == 1
+        rows = np.asarray([0, 1, 2])
+        transitions[0] = transitions[3]
+        terminal[0] = terminal[3]
+
+        def learned_option(storage, history):
+            option = Option(0, fa, FixedPolicy(4, 0), 0.1, 0.99, None, 4, storage=storage)
+            for (fv, fv_prime), t in history:
+                option.update_m(fv, fv_prime, 0)
+                option.update_u(fv, fv_prime, t)
+            return option
+
+        for storage in ['dense', 'sparse', 'low_rank']:
+            history = list(zip(transitions[1:], [False, False]))
+            option = learned_option(storage, history)
+            option.update_m_batch(buffer.features(rows), buffer.features(rows, next_state=True), 0)
+            option.update_u_batch(buffer.features(rows), buffer.features(rows, next_state=True), buffer.terminal[rows])
+            start = learned_option(storage, history)
+            singles = [learned_option(storage, history + [(transitions[i], terminal[i])]) for i in range(3)]
+            for model in ['m_model', 'u_model']:
+                expected = getattr(start, model).to_dense() + np.mean(
+                    [getattr(single, model).to_dense() - getattr(start, model).to_dense() for single in singles], axis=0)
+                assert np.allclose(getattr(option, model).to_dense(), expected)
+
+
+def test_memmap_option_models(tmp_path):
+    """Do agents with memory-mapped option models keep them in files in the option directory and learn and plan exactly
+    like agents with in-memory models?"""
+    in_memory = explored_agent()
+    in_memory.plan()
+    memmapped = explored_agent(option_storage='memmap', option_dir=str(tmp_path))
+    memmapped.plan()
+    assert np.array_equal(in_memory.vi.theta, memmapped.vi.theta)
+    for i, o in memmapped.options.items():
+        assert isinstance(o.m, np.memmap) and isinstance(o.u, np.memmap)
+        assert np.array_equal(o.m, in_memory.options[i].m) and np.array_equal(o.u, in_memory.options[i].u)
+        assert np.array_equal(np.load(str(tmp_path / 'u{}.npy'.format(i))), o.u)
+
+
+def test_memmap_default_directory():
+    """Is the temporary directory of the memmap option models of an agent without an option directory removed with the
+    agent?"""
+    agent = explored_agent(steps=10, option_storage='memmap')
+    directory = agent.option_dir
+    assert os.path.isfile(os.path.join(directory, 'm0.npy'))
+    del agent
+    gc.collect()
+    assert not os.path.exists(directory)
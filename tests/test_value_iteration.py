@@ -0,0 +1,334 @@
+"""Test value iteration over learned option models."""
+
+# System
+import random
+
+# Third party
+import numpy as np
+
+# First party
+from imrl.agent.value_iteration import ValueIteration
+from imrl.agent.policy.policy_vi import feature_key
+from imrl.agent.fa.tabular import TabularFA
+from imrl.agent.fa.rbf import RBF
+from imrl.environment.gridworld_continuous import GridworldContinuous
+from imrl.utils.linear_algebra import inner, add_scaled
+from tests.tools import explored_agent
+
+
+def test_batched_option_values():
+    """Do the values computed over the stacked option models match the option by option values?"""
+    agent = explored_agent()
+    assert len(agent.options) > agent.num_actions
+    agent.plan()
+    for vi in [agent.vi] + [agent.options[i].policy.vi for i in range(agent.num_actions, len(agent.options))]:
+        vi.use_options = True
+        for s in range(9):
+            fv = agent.fa.evaluate(s)
+            expected = [vi.get_value(vi.theta, agent.options[i], fv).item() for i in vi.option_ids()]
+            assert np.allclose(vi.get_values(vi.theta, fv), expected)
+    for i, o in agent.options.items():
+        assert np.shares_memory(o.m, agent.model_stack.m_t) and np.shares_memory(o.u, agent.model_stack.u_t)
+        assert np.array_equal(o.m, agent.model_stack.m_t[i].T)
+
+
+def test_unstacked_option_values():
+    """Do agents with non-dense option models compute the same values without a model stack?"""
+    stacked = explored_agent()
+    unstacked = explored_agent(option_storage='sparse')
+    assert unstacked.model_stack is None
+    for s in range(9):
+        assert np.allclose(stacked.vi.get_values(stacked.vi.theta, stacked.fa.evaluate(s)),
+                           unstacked.vi.get_values(unstacked.vi.theta, unstacked.fa.evaluate(s)))
+
+
+def test_float32_matches_float64():
+    """Does a float32 agent keep every array in float32 and stay within tolerance of the float64 agent?
+    float32 carries about 7 significant digits. Over a few hundred model updates and a value iteration run the rounding
+    errors accumulate to around 1e-6, so the float32 models and value function must agree with float64 to within an
+    absolute tolerance of 1e-4."""
+    for storage in ['dense', 'sparse', 'low_rank']:
+        agents = [explored_agent(TabularFA(9, 4, dtype=dtype), option_storage=storage) for dtype in [np.float64, np.float32]]
+        agents += [explored_agent(RBF(2, 3, 4, dtype=dtype), environment=GridworldContinuous(0.2, 0.01), option_storage=storage)
+                   for dtype in [np.float64, np.float32]]
+        for reference, agent in [agents[:2], agents[2:]]:
+            agent.vi.run()
+            reference.vi.run()
+            assert agent.vi.theta.dtype == np.float32 and all(r.dtype == np.float32 for r in agent.intrinsic)
+            assert np.allclose(agent.vi.theta, reference.vi.theta, atol=1e-4)
+            for i, o in agent.options.items():
+                assert o.m_model.to_dense().dtype == np.float32 and o.u_model.to_dense().dtype == np.float32
+                assert np.allclose(o.m_model.to_dense(), reference.options[i].m_model.to_dense(), atol=1e-4)
+                assert np.allclose(o.u_model.to_dense(), reference.options[i].u_model.to_dense(), atol=1e-4)
+
+
+def test_reward_projection_cache():
+    """Are the cached reward projections reused while U and r are unchanged, and recomputed once either changes?"""
+    agent = explored_agent()
+    vi = agent.vi
+    o = agent.options[1]
+    fv = agent.fa.evaluate(4)
+    w = o.projection(vi.r[1], agent.reward_version(vi.r[1]))
+    assert o.projection(vi.r[1], agent.reward_version(vi.r[1])) is w
+    values = vi.get_values(vi.theta, fv)
+    projection_matrix = vi.projection_matrix
+    assert np.array_equal(vi.get_values(vi.theta, fv), values) and vi.projection_matrix is projection_matrix
+    o.update_u(fv, agent.fa.evaluate(5), False)
+    agent.update_intrinsic_reward(4, 2)
+    expected = [(agent.options[i].get_return(vi.r[i], fv) + vi.gamma * np.dot(agent.options[i].get_next_fv(fv).T, vi.theta)).item()
+                for i in vi.option_ids()]
+    assert not np.allclose(values, expected)
+    assert np.allclose(vi.get_values(vi.theta, fv), expected)
+    assert o.projection(vi.r[1], agent.reward_version(vi.r[1])) is not w
+
+
+def test_sample_features():
+    """Does the sample feature matrix hold the feature vector of every sample at the row given by sample_rows?"""
+    for agent in [explored_agent(), explored_agent(RBF(2, 3, 4, cutoff=0.5), environment=GridworldContinuous(0.2, 0.01))]:
+        phi = agent.sample_features.matrix.toarray()
+        assert phi.shape == (len(agent.samples), agent.fa.num_features)
+        for s, row in zip(agent.samples, agent.sample_rows):
+            assert np.allclose(phi[row], np.asarray(agent.fa.evaluate(s))[:, 0])
+
+
+def test_jacobi_sweep():
+    """Does a synchronous sweep apply the normalized sum of the backups of every sample from the same value function, and
+    does the sample by sample sweep match backing up each sample's feature vector in turn?"""
+    for fa, environment in [(None, None), (RBF(2, 3, 4, cutoff=0.5), GridworldContinuous(0.2, 0.01))]:
+        agent = explored_agent(fa, environment=environment)
+        for vi in [agent.vi] + [agent.options[i].policy.vi for i in range(agent.num_actions, len(agent.options))]:
+            vi.run()
+            theta = vi.theta.copy()
+            samples = agent.samples if vi.id < 0 else agent.options[vi.id].get_init_set()
+            update = np.zeros_like(theta)
+            scale = np.zeros_like(theta)
+            for fv in agent.fa.evaluate_each(samples):
+                add_scaled(update, fv, vi.alpha * (np.max(vi.get_values(theta, fv)) - inner(theta, fv).item()))
+                scale += np.abs(np.asarray(fv)) * np.sum(np.abs(np.asarray(fv)))
+            expected = theta + update / np.where(scale == 0, 1.0, scale)
+            if fa is None:
+                assert np.array_equal(scale[scale != 0], np.ones(len(samples)))
+            vi.ordering = 'jacobi'
+            assert np.allclose(vi.sweep(theta.copy()), expected)
+            for fv in agent.fa.evaluate_each(samples):
+                theta = vi.backup(theta, fv)
+            vi.ordering = 'gauss_seidel'
+            assert np.allclose(vi.sweep(vi.theta.copy()), theta)
+
+
+def test_residual_stopping():
+    """Does value iteration record a residual per sweep and stop once it falls below the tolerance?"""
+    agent = explored_agent()
+    for ordering in ['gauss_seidel', 'jacobi']:
+        for norm in ['max', 'l2']:
+            vi = ValueIteration(-1, agent.intrinsic, agent, 1000, use_options=False, alpha=0.5, gamma=0.9, ordering=ordering,
+                                tolerance=1e-6, residual_norm=norm)
+            errors = [vi.bellman_error(vi.theta, agent.fa.evaluate(s)) for s in agent.samples]
+            vi.run()
+            if ordering == 'jacobi':  # Gauss-Seidel backups see the updates of the earlier samples of the sweep
+                assert np.isclose(vi.residuals[0], np.max(np.abs(errors)) if norm == 'max' else np.linalg.norm(errors))
+            assert 1 < len(vi.residuals) < 1000
+            assert vi.residuals[-1] <= 1e-6 < min(vi.residuals[:-1])
+            vi.tolerance = None
+            vi.iterations = 3
+            vi.run()
+            assert len(vi.residuals) == 3
+
+
+def test_prioritized_sweeping():
+    """Does prioritized sweeping converge to the value function of full sweeps, only back up seeded rows and their
+    predecessors, and respect its budget?"""
+    agent = explored_agent()
+    vis = {ordering: ValueIteration(-1, agent.intrinsic, agent, 10000, alpha=0.5, gamma=0.9, ordering=ordering, tolerance=1e-9)
+           for ordering in ['gauss_seidel', 'prioritized']}
+    for vi in vis.values():
+        vi.run()
+    assert np.allclose(vis['prioritized'].theta, vis['gauss_seidel'].theta, atol=1e-6)
+    vi = vis['prioritized']
+    vi.run(seeds=[])
+    assert vi.residuals == []
+    goal = agent.samples.index(8)
+    agent.intrinsic[2][8, 0] += 1.0
+    agent.reward_versions[id(agent.intrinsic[2])] += 1
+    vi.budget = 1
+    vi.run(seeds=[agent.sample_rows[goal]])
+    assert len(vi.residuals) == 1
+    assert set(vi.priorities) == set(agent.sample_rows[i] for i, s in enumerate(agent.samples) if s in (5, 7))
+
+
+def test_prioritized_first_run():
+    """Does the first prioritized run of a new option back up all of its rows, whatever the seeds, and converge to the
+    value function of full sweeps?"""
+    agent = explored_agent(vi_ordering='prioritized', vi_tolerance=1e-10, vi_budget=10 ** 6)
+    vi = agent.options[agent.num_actions].policy.vi
+    vi.run(seeds=[])
+    expected = ValueIteration(vi.id, vi.r, agent, 10000, alpha=vi.alpha, gamma=vi.gamma, tolerance=1e-10)
+    expected.run()
+    assert np.any(vi.theta != 0)
+    assert np.allclose(vi.theta, expected.theta, atol=1e-6)
+    vi.run(seeds=[])
+    assert vi.residuals == []
+
+
+def test_policy_iteration():
+    """Does policy iteration reach the fixed point of value iteration sweeps in a few iterations on tabular features?"""
+    for storage in ['dense', 'sparse', 'low_rank']:
+        agent = explored_agent(option_storage=storage)
+        goal = [agent.fa.evaluate(8).to_dense()]
+        vis = {ordering: ValueIteration(-1, goal, agent, 5000, alpha=1.0, gamma=0.9, ordering=ordering, tolerance=1e-12)
+               for ordering in ['gauss_seidel', 'policy_iteration']}
+        for vi in vis.values():
+            vi.run()
+        assert len(vis['policy_iteration'].residuals) < 10 < len(vis['gauss_seidel'].residuals)
+        assert vis['policy_iteration'].residuals[-1] < 1e-10
+        assert np.allclose(vis['policy_iteration'].theta, vis['gauss_seidel'].theta)
+
+
+def test_parallel_planning():
+    """Does planning the options in forked processes learn what planning them in this process with the same seeds does,
+    whatever the number of workers, and leave the value iterations drawing from the agent's generator?"""
+    results = []
+    for workers in [0, 1, 3]:
+        agent = explored_agent(plan_workers=max(workers, 1))
+        if workers == 0:
+            agent.plan_forked = lambda options, seeds: [agent.plan_option(o, random.Random(seed)) for o, seed in zip(options, seeds)]
+        for _ in range(3):
+            agent.plan()
+        assert all(o.policy.vi.random is agent.random for o in list(agent.options.values())[agent.num_actions:])
+        results.append([agent.vi.theta] + [o.policy.vi.theta for o in list(agent.options.values())[agent.num_actions:]] +
+                       [o.m for o in agent.options.values()] + [o.u for o in agent.options.values()])
+    assert len(results[0]) > 3
+    for serial, forked in [(results[0], results[1]), (results[0], results[2])]:
+        for a, b in zip(serial, forked):
+            assert np.array_equal(a, b)
+
+
+def test_batched_simulation():
+    """Does simulating an option from one start sample at a time in a batch learn the same models as the serial
+    simulation, and does simulating from many start samples together stop when all of them have terminated?"""
+    agents = []
+    for _ in range(2):
+        agents.append(explored_agent(steps=1000))
+        agents[-1].plan()
+    serial, batched = [agent.options[agent.num_actions] for agent in agents]
+    for s, row in zip(agents[0].samples, agents[0].sample_rows):
+        serial.policy.vi.random = random.Random(0)
+        batched.policy.vi.random = random.Random(0)
+        agents[0].simulate_policy(serial, s, 1)
+        agents[1].simulate_policy_batch(batched, [row], 1)
+    assert np.allclose(serial.u, batched.u) and np.allclose(serial.m, batched.m)
+    assert np.any(serial.m != 0)
+    agent = agents[1]
+    agent.simulate_policy_batch(batched, agent.sample_rows, 5)
+    assert np.all(np.isfinite(batched.u)) and np.all(np.isfinite(batched.m))
+
+
+def test_batched_simulation_trajectories():
+    """Does a multi-step batched simulation from distinct tabular starts follow each start's trajectory, learn U from
+    every step's transitions and, when simulations terminate, learn M from every state of their trajectories, discounted
+    by the number of steps from each state to termination?"""
+    agent = explored_agent(steps=1000)
+    agent.plan()
+    o = agent.options[agent.num_actions]
+    recorded = {'actions': [], 'm': [], 'u': []}
+    choose_actions, update_m_batch, update_u_batch = o.policy.choose_actions_from_fm, o.update_m_batch, o.update_u_batch
+
+    def record_actions(fm):
+        recorded['actions'].append(choose_actions(fm))
+        return recorded['actions'][-1]
+
+    def checked_update(name, update, fm, fm_prime, tau_or_terminal, per_feature):
+        model = o.m if name == 'm' else o.u
+        x, x_prime, before = fm.toarray(), fm_prime.toarray(), model.copy()
+        recorded[name].append((x, x_prime, np.asarray(tau_or_terminal)))
+        update(fm, fm_prime, tau_or_terminal, per_feature=False)
+        if name == 'm':
+            delta = (o.gamma ** np.asarray(tau_or_terminal, dtype=float))[:, np.newaxis] * x_prime - x.dot(before.T)
+        else:
+            delta = x - x.dot(before.T) + o.gamma * ~np.asarray(tau_or_terminal)[:, np.newaxis] * x_prime.dot(before.T)
+        assert np.allclose(model, before + o.eta / len(x) * delta.T.dot(x))
+
+    o.policy.choose_actions_from_fm = record_actions
+    o.update_m_batch = lambda fm, fm_prime, tau, per_feature: checked_update('m', update_m_batch, fm, fm_prime, tau, per_feature)
+    o.update_u_batch = lambda fm, fm_prime, terminal, per_feature: \
+        checked_update('u', update_u_batch, fm, fm_prime, terminal, per_feature)
+    primitive_m = [agent.options[a].m.copy() for a in range(agent.num_actions)]
+    rows = agent.sample_rows
+    agent.simulate_policy_batch(o, rows, 5)
+
+    # Replay the chosen actions on each start's own trajectory
+    trajectories = [[agent.sample_features.matrix[row].toarray()[0]] for row in rows]
+    running = list(range(len(rows)))
+    expected_m = []
+    for step, actions in enumerate(recorded['actions']):
+        x = np.stack([trajectories[k][-1] for k in running])
+        x_prime = np.stack([primitive_m[a].dot(trajectories[k][-1]) for k, a in zip(running, actions)])
+        terminal = o.is_terminal_batch(x_prime)
+        assert np.allclose(recorded['u'][step][0], x) and np.allclose(recorded['u'][step][1], x_prime)
+        assert np.array_equal(recorded['u'][step][2], terminal)
+        terminated = [k for k, t in zip(running, terminal) if t]
+        if terminated:
+            successors = {k: x_prime[j] for j, k in enumerate(running) if terminal[j]}
+            expected_m.append([(trajectories[k][t], successors[k], step - t) for t in range(step + 1) for k in terminated])
+        for j, k in enumerate(running):
+            trajectories[k].append(x_prime[j])
+        running = [k for k, t in zip(running, terminal) if not t]
+    assert len(recorded['m']) == len(expected_m) > 1
+    assert any(tau > 0 for expected in expected_m for _, _, tau in expected)
+    for (x, x_prime, tau), expected in zip(recorded['m'], expected_m):
+        assert np.allclose(x, [state for state, _, _ in expected])
+        assert np.allclose(x_prime, [successor for _, successor, _ in expected])
+        assert np.array_equal(tau, [tau for _, _, tau in expected])
+
+
+def test_greedy_policy_table():
+    """Does the tabulated greedy policy hold the live greedy choices at the samples until the value iteration runs again
+    or samples are added, whatever the model updates in between, and fall back to the live computation elsewhere?"""
+    agent = explored_agent(steps=100)
+    agent.plan()
+    for o in list(agent.options.values())[agent.num_actions:] + [None]:
+        policy = o.policy if o is not None else agent.vi_policy
+        vi = policy.vi
+        assert policy.table_key == policy.key() and len(policy.table) == len(agent.samples)
+        for s in agent.samples:
+            ids = vi.option_ids()
+            values = vi.get_values(vi.theta, agent.fa.evaluate(s))
+            best = [ids[i] for i in np.flatnonzero(values == np.max(values))]
+            best = [i for i in best if i < agent.num_actions] or best
+            assert set(policy.table[agent.fa.evaluate(s).index]) == set(best)
+            assert policy.choose_action(s) in best
+        vi.run()
+        assert policy.table_key != policy.key()
+    agent.vi_policy.update_table()
+    agent.options[0].update_m(agent.fa.evaluate(0), agent.fa.evaluate(1), 0)
+    assert agent.vi_policy.table_key == agent.vi_policy.key()
+    agent = explored_agent(RBF(2, 3, 4), steps=100, environment=GridworldContinuous(0.2, 0.01))
+    agent.plan()
+    unseen = agent.fa.evaluate(np.asarray([0.123, 0.456]))
+    assert feature_key(unseen) not in agent.vi_policy.table
+    assert agent.vi_policy.choose_action_from_fv(unseen) == agent.vi_policy.vi.get_max_action(unseen)
+    samples = len(agent.samples)
+    agent.evaluate_sample(np.asarray([0.123, 0.456]))
+    assert len(agent.samples) == samples + 1 and agent.vi_policy.table_key != agent.vi_policy.key()
+
+
+def test_incremental_planning():
+    """Are only the options with new samples or large enough model updates replanned, and are they reported?"""
+    agent = explored_agent(plan_threshold=1e9)
+    subgoal_ids = list(range(agent.num_actions, len(agent.options)))
+    assert agent.plan() == subgoal_ids
+    theta = {i: agent.options[i].policy.vi.theta.copy() for i in subgoal_ids}
+    assert agent.plan() == [] and agent.replanned == []
+    for i in subgoal_ids:
+        assert np.array_equal(agent.options[i].policy.vi.theta, theta[i])
+        assert agent.planning_change(agent.options[i]) == (0.0, 0)
+    agent.update(0, agent.choose_action(0), 1)
+    touched = set(agent.touched_rows)
+    assert agent.plan() == []
+    for i in subgoal_ids:
+        assert agent.options[i].pending_rows == touched
+    agent.plan_threshold = 0.0
+    agent.update(0, agent.choose_action(0), 1)
+    assert agent.plan() == subgoal_ids
+    for i in subgoal_ids:
+        assert agent.options[i].pending_rows == set()
@@ -1,5 +1,17 @@
 """Test the combination lock."""
 
+# System
+import random
+
+# Third party
+import numpy as np
+
+# First party
+from imrl.agent.agent import Agent
+from imrl.agent.fa.tabular import TabularFA
+from imrl.agent.policy.policy_random import RandomPolicy
+from imrl.environment.gridworld import Gridworld
+
 
 def generate_test(repeated_function, limit):
     """Generate an arbitrary function limit times."""
@@ -10,3 +22,20 @@ def generate_test(repeated_function, limit):
 def ratio_test(predicate, repeated_function, limit):
     """Perform the function up to the limit number of times and return the ratio of runs that satisfied the predicate"""
     return sum(map(predicate, generate_test(repeated_function, limit))) / limit
+
+
+def explored_agent(fa=None, steps=300, environment=None, **kwargs):
+    """Return an agent that has taken random actions for the given number of steps, by default in a 3x3 gridworld."""
+    random.seed(0)
+    np.random.seed(0)
+    environment = environment or Gridworld(3, 3, 0.0)
+    fa = fa or TabularFA(environment.num_states(), environment.num_actions)
+    agent = Agent(RandomPolicy(environment.num_actions), fa, environment.num_actions, 0.1, 0.9, 0.1, 0.1, 0.05, 10, 5, 5,
+                  subgoals=environment.create_subgoals(), samples=[], **kwargs)
+    state = environment.initial_state()
+    for _ in range(steps):
+        action = agent.choose_action(state)
+        state_prime = environment.next_state(state, action)
+        agent.update(state, action, state_prime)
+        state = state_prime
+    return agent